@@ -5,27 +5,699 @@ This module provide utility functions for insert operation.
 """
 
 import typing as T
+import io
+import copy
+import csv
+import json
+import uuid
+import itertools
 import math
+import time
+import threading
+import warnings
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
 
 import sqlalchemy as sa
 from sqlalchemy.exc import IntegrityError
 
-from ..utils import grouper_list
+from ..utils import (
+    grouper_list,
+    get_pk_value,
+    get_pk_normalizer,
+    get_max_rows_per_statement,
+    select_existing_pks,
+    BatchCommitter,
+)
+
+#: default number of rows in each window when the ``data`` is an iterator
+DEFAULT_WINDOW_SIZE = 1000
+
+_insert_strategies = {
+    "split",
+    "bisect",
+    "on_conflict",
+    "adaptive",
+}
+
+
+@dataclasses.dataclass
+class RejectedRow:
+    """
+    A row that is not inserted by :func:`smart_insert` or
+    :meth:`~sqlalchemy_mate.orm.extended_declarative_base.ExtendedBase.smart_insert`.
+
+    :param row: the original row dict, or the ORM object.
+    :param error_class: the DBAPI driver exception class, for example
+        ``sqlite3.IntegrityError``. None if the row is skipped without sending
+        it to the database individually (``prefilter`` or ``on_conflict``).
+    """
+
+    row: T.Any = dataclasses.field()
+    error_class: T.Optional[T.Type[Exception]] = dataclasses.field(default=None)
+
+    def to_dict(self) -> dict:
+        """
+        Convert the row to a dict, ORM object is converted by its ``to_dict``
+        method.
+        """
+        if isinstance(self.row, dict):
+            return self.row
+        else:
+            return self.row.to_dict()
+
+    @property
+    def error_name(self) -> T.Optional[str]:
+        """
+        The full name of the error class, for example
+        ``"sqlite3.IntegrityError"``.
+        """
+        if self.error_class is None:
+            return None
+        return f"{self.error_class.__module__}.{self.error_class.__qualname__}"
+
+
+T_REJECTED_SINK = T.Union[T.List[RejectedRow], T.Callable[[RejectedRow], T.Any]]
+
+
+def report_rejected(
+    rejected: T.Optional[T_REJECTED_SINK],
+    row: T.Any,
+    error: T.Optional[Exception] = None,
+):
+    """
+    Send a rejected row to the sink. The sink can be a list, or a callable that
+    takes a :class:`RejectedRow`, for example :class:`JsonLinesRejectWriter`
+    and :class:`CsvRejectWriter`.
+
+    :param error: the sqlalchemy exception, the class of the underlying DBAPI
+        exception is reported if there is one.
+    """
+    if rejected is None:
+        return
+    if error is None:
+        error_class = None
+    elif getattr(error, "orig", None) is not None:
+        error_class = type(error.orig)
+    else:
+        error_class = type(error)
+    rejected_row = RejectedRow(row=row, error_class=error_class)
+    if isinstance(rejected, list):
+        rejected.append(rejected_row)
+    else:
+        rejected(rejected_row)
+
+
+class _RejectWriter:
+    """
+    Base class of the file based rejected row sink. It is a callable and a
+    context manager, it has to be used in a ``with`` block, so the file is
+    always closed. The file is truncated when it is opened the first time,
+    reusing the writer in another ``with`` block appends to it. It is thread
+    safe.
+    """
+
+    def __init__(self, path: str, encoding: str = "utf-8"):
+        self.path = path
+        self.encoding = encoding
+        self.file = None
+        self.n_opened = 0
+        self._lock = threading.Lock()
+
+    def open(self):
+        mode = "w" if self.n_opened == 0 else "a"
+        self.file = open(self.path, mode, encoding=self.encoding, newline="")
+        self.n_opened += 1
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, rejected_row: RejectedRow):  # pragma: no cover
+        raise NotImplementedError
+
+    def __call__(self, rejected_row: RejectedRow):
+        with self._lock:
+            if self.file is None:
+                raise RuntimeError(
+                    f"{self.__class__.__name__} is not open, "
+                    f"use it in a ``with`` statement"
+                )
+            self.write(rejected_row)
+
+
+class JsonLinesRejectWriter(_RejectWriter):
+    """
+    Write rejected rows to a JSON lines file, one
+    ``{"row": {...}, "error_class": "..."}`` object per line. Value that is not
+    JSON serializable is converted to string.
+
+    Example::
+
+        with JsonLinesRejectWriter("rejected.jsonl") as writer:
+            smart_insert(engine, t_users, data, rejected=writer)
+    """
+
+    def write(self, rejected_row: RejectedRow):
+        record = {"row": rejected_row.to_dict(), "error_class": rejected_row.error_name}
+        self.file.write(json.dumps(record, default=str) + "\n")
+
+
+class CsvRejectWriter(_RejectWriter):
+    """
+    Write rejected rows to a CSV file, the columns are the keys of the row plus
+    an ``error_class`` column.
+
+    :param fieldnames: the row keys in the CSV header, by default it is
+        the keys of the first rejected row.
+
+    Example::
+
+        with CsvRejectWriter("rejected.csv") as writer:
+            smart_insert(engine, t_users, data, rejected=writer)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fieldnames: T.Optional[T.List[str]] = None,
+        encoding: str = "utf-8",
+    ):
+        super().__init__(path=path, encoding=encoding)
+        self.fieldnames = fieldnames
+        self.writer = None
+
+    def close(self):
+        super().close()
+        self.writer = None
+
+    def write(self, rejected_row: RejectedRow):
+        row = rejected_row.to_dict()
+        if self.writer is None:
+            if self.fieldnames is None:
+                self.fieldnames = list(row)
+            self.writer = csv.DictWriter(
+                self.file, fieldnames=self.fieldnames + ["error_class"]
+            )
+            # don't repeat the header when appending to the file
+            if self.file.tell() == 0:
+                self.writer.writeheader()
+        self.writer.writerow({**row, "error_class": rejected_row.error_name})
+
+
+class AdaptiveBatchSizer:
+    """
+    Decide the size of the next bulk INSERT attempt based on the observed
+    IntegrityError rate and statement latency, the same way TCP congestion
+    control decides its window size (AIMD).
+
+    - Slow start: the size doubles after each success until it reaches
+        the threshold.
+    - Congestion avoidance: above the threshold, the size grows by
+        ``increase_ratio`` after each success, damped by the recent error rate.
+    - Multiplicative decrease: on IntegrityError, both the threshold and the
+        size drop to half of the failed batch size. If a successful statement
+        is slower than ``target_latency`` seconds, the size is halved too.
+
+    :param initial_size: the size of the first attempt.
+    :param min_size: the size never goes below this value.
+    :param max_size: the size never goes above this value.
+    :param target_latency: the expected max seconds of one statement.
+    :param increase_ratio: the growth ratio in congestion avoidance phase.
+    :param smoothing: the weight of the latest attempt in :attr:`error_rate`.
+
+    **中文文档**
+
+    参考 TCP 拥塞控制 (AIMD) 的思路, 根据最近的 IntegrityError 出现频率以及语句的
+    执行时间动态调整下一次 Bulk Insert 的大小. 数据干净时批次会越来越大, 数据脏时
+    批次会更早地被拆小, 不需要每次都浪费一个完整大小的失败 INSERT.
+    """
+
+    def __init__(
+        self,
+        initial_size: int = 100,
+        min_size: int = 1,
+        max_size: int = 10000,
+        target_latency: float = 1.0,
+        increase_ratio: float = 0.1,
+        smoothing: float = 0.2,
+    ):
+        self.size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.increase_ratio = increase_ratio
+        self.smoothing = smoothing
+        self.threshold = max_size
+        self.error_rate = 0.0
+
+    def _update_error_rate(self, failed: bool):
+        self.error_rate = (1 - self.smoothing) * self.error_rate + self.smoothing * (
+            1.0 if failed else 0.0
+        )
+
+    def succeeded(self, n_rows: int, elapsed: float):
+        """
+        Report a successful attempt of ``n_rows`` rows that took ``elapsed``
+        seconds.
+        """
+        self._update_error_rate(failed=False)
+        if elapsed > self.target_latency:
+            self.size = max(self.min_size, self.size // 2)
+            self.threshold = self.size
+        elif n_rows < self.size:  # the last batch of the data, no signal
+            pass
+        elif self.size < self.threshold:
+            self.size = min(self.threshold, self.max_size, self.size * 2)
+        else:
+            step = self.size * self.increase_ratio * (1 - self.error_rate)
+            self.size = min(self.max_size, self.size + max(1, int(step)))
+
+    def failed(self, n_rows: int):
+        """
+        Report a failed attempt of ``n_rows`` rows.
+        """
+        self._update_error_rate(failed=True)
+        self.size = max(self.min_size, min(self.size, n_rows) // 2)
+        self.threshold = self.size
+
+
+def get_on_conflict_do_nothing_insert(
+    table: sa.Table,
+    dialect: sa.Dialect,
+) -> T.Optional[sa.Insert]:
+    """
+    Return an INSERT statement that silently skip the rows that violate
+    unique / primary key constraint. Return None if the dialect doesn't support
+    this feature.
+
+    .. note::
+
+        On MySQL / MariaDB this is ``INSERT IGNORE``, which not only skips the
+        duplicated rows, but also downgrades other errors to warnings, invalid
+        values are silently coerced (for example, NULL in a NOT NULL column
+        becomes ``0`` or ``''``, a too long string is truncated).
+
+    **中文文档**
+
+    根据数据库的方言, 返回一个遇到主键或唯一约束冲突时自动跳过的 INSERT 语句. 如果
+    该数据库不支持这一语法, 则返回 None.
+
+    注意在 MySQL / MariaDB 中使用的是 ``INSERT IGNORE``, 它除了跳过重复的行之外, 还会
+    把其他错误降级为警告, 非法的值会被静默地转换 (例如 NOT NULL 列中的 NULL 变成 ``0``
+    或 ``''``, 过长的字符串被截断).
+    """
+    if dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+
+        return insert(table).on_conflict_do_nothing()
+    elif dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+
+        return insert(table).on_conflict_do_nothing()
+    elif dialect.name in ("mysql", "mariadb"):
+        return table.insert().prefix_with("IGNORE")
+    else:
+        return None
+
+
+def _row_by_row_insert(
+    committer: BatchCommitter,
+    table: sa.Table,
+    data: T.List[dict],
+    op_counter: int,
+    ins_counter: int,
+    rejected: T.Optional[T_REJECTED_SINK],
+) -> T.Tuple[int, int]:
+    """
+    Insert rows one by one, skip the failed ones.
+    """
+    connection = committer.conn
+    insert = table.insert()
+    for row in data:
+        try:
+            with committer.attempt():
+                connection.execute(insert.values(**row))
+            committer.succeeded(1)
+            op_counter += 1
+            ins_counter += 1
+        except IntegrityError as e:
+            report_rejected(rejected, row, e)
+    return op_counter, ins_counter
+
+
+def _split_insert(
+    committer: BatchCommitter,
+    table: sa.Table,
+    data: T.List[dict],
+    minimal_size: int,
+    op_counter: int,
+    ins_counter: int,
+    rejected: T.Optional[T_REJECTED_SINK],
+) -> T.Tuple[int, int]:
+    """
+    The recursive "try bulk insert, then split" implementation of
+    :func:`smart_insert`.
+    """
+    connection = committer.conn
+    insert = table.insert()
+
+    # 首先进行尝试 bulk insert
+    try:
+        with committer.attempt():
+            connection.execute(insert, data)
+        committer.succeeded(len(data))
+        op_counter += 1
+        ins_counter += len(data)
+    # 失败了
+    except IntegrityError as e:
+        # 分析数据量
+        n = len(data)
+        # 只有一条数据, 则无需再次尝试
+        if n == 1:
+            report_rejected(rejected, data[0], e)
+        # 如果数据条数多于一定数量
+        elif n >= minimal_size**2:
+            # 则进行分包
+            n_chunk = math.floor(math.sqrt(n))
+            for chunk in grouper_list(data, n_chunk):
+                op_counter, ins_counter = _split_insert(
+                    committer=committer,
+                    table=table,
+                    data=chunk,
+                    minimal_size=minimal_size,
+                    op_counter=op_counter,
+                    ins_counter=ins_counter,
+                    rejected=rejected,
+                )
+        # 否则则一条条地逐条插入
+        else:
+            op_counter, ins_counter = _row_by_row_insert(
+                committer=committer,
+                table=table,
+                data=data,
+                op_counter=op_counter,
+                ins_counter=ins_counter,
+                rejected=rejected,
+            )
+    return op_counter, ins_counter
+
+
+def _bisect_insert(
+    committer: BatchCommitter,
+    table: sa.Table,
+    data: T.List[dict],
+    op_counter: int,
+    ins_counter: int,
+    rejected: T.Optional[T_REJECTED_SINK],
+) -> T.Tuple[int, int]:
+    """
+    The binary search implementation of :func:`smart_insert`. The failed batch
+    is split into two halves, a half that succeeded is never re-sent. It finds
+    ``k`` bad rows in ``n`` rows with about ``O(k * log(n))`` statements.
+    """
+    connection = committer.conn
+    insert = table.insert()
+    try:
+        with committer.attempt():
+            connection.execute(insert, data)
+        committer.succeeded(len(data))
+        op_counter += 1
+        ins_counter += len(data)
+    except IntegrityError as e:
+        if len(data) == 1:
+            report_rejected(rejected, data[0], e)
+        else:
+            middle = len(data) // 2
+            for half in (data[:middle], data[middle:]):
+                op_counter, ins_counter = _bisect_insert(
+                    committer=committer,
+                    table=table,
+                    data=half,
+                    op_counter=op_counter,
+                    ins_counter=ins_counter,
+                    rejected=rejected,
+                )
+    return op_counter, ins_counter
+
+
+def _adaptive_insert(
+    committer: BatchCommitter,
+    table: sa.Table,
+    data: T.List[dict],
+    minimal_size: int,
+    sizer: AdaptiveBatchSizer,
+    op_counter: int,
+    ins_counter: int,
+    rejected: T.Optional[T_REJECTED_SINK],
+    max_batch_size: T.Optional[int] = None,
+) -> T.Tuple[int, int]:
+    """
+    The adaptive batch size implementation of :func:`smart_insert`. The failed
+    batch is re-inserted with the shrunk batch size, the succeeded batches
+    are never re-sent.
+
+    :param max_batch_size: the batch size never goes above this value. A failed
+        batch is re-inserted with at most half of its size, so the recursion
+        always terminates, even if the sizer is clamped by its ``min_size``.
+    """
+    connection = committer.conn
+    insert = table.insert()
+    i = 0
+    while i < len(data):
+        if max_batch_size is None:
+            size = sizer.size
+        else:
+            size = min(sizer.size, max_batch_size)
+        batch = data[i : i + size]
+        i += len(batch)
+        st = time.perf_counter()
+        try:
+            with committer.attempt():
+                connection.execute(insert, batch)
+            sizer.succeeded(len(batch), time.perf_counter() - st)
+            committer.succeeded(len(batch))
+            op_counter += 1
+            ins_counter += len(batch)
+        except IntegrityError as e:
+            sizer.failed(len(batch))
+            if len(batch) == 1:
+                report_rejected(rejected, batch[0], e)
+            elif len(batch) <= minimal_size:
+                op_counter, ins_counter = _row_by_row_insert(
+                    committer=committer,
+                    table=table,
+                    data=batch,
+                    op_counter=op_counter,
+                    ins_counter=ins_counter,
+                    rejected=rejected,
+                )
+            else:
+                op_counter, ins_counter = _adaptive_insert(
+                    committer=committer,
+                    table=table,
+                    data=batch,
+                    minimal_size=minimal_size,
+                    sizer=sizer,
+                    op_counter=op_counter,
+                    ins_counter=ins_counter,
+                    rejected=rejected,
+                    max_batch_size=len(batch) // 2,
+                )
+    return op_counter, ins_counter
+
+
+def _drop_existing_rows(
+    connection: sa.Connection,
+    table: sa.Table,
+    data: T.List[dict],
+    rejected: T.Optional[T_REJECTED_SINK],
+) -> T.List[dict]:
+    """
+    Drop the rows whose primary key already exists in the table, or already
+    appeared earlier in ``data``. Rows without full primary key values
+    (for example, auto increment id) are kept.
+    """
+    pk_names = [col.name for col in table.primary_key]
+    pk_values = [get_pk_value(pk_names, row) for row in data]
+    existing = select_existing_pks(
+        connection,
+        table,
+        [pk for pk in set(pk_values) if None not in pk],
+    )
+    rows = list()
+    for pk, row in zip(pk_values, data):
+        if None in pk:
+            rows.append(row)
+        elif pk not in existing:
+            existing.add(pk)
+            rows.append(row)
+        else:
+            report_rejected(rejected, row)
+    return rows
+
+
+def _on_conflict_insert(
+    committer: BatchCommitter,
+    table: sa.Table,
+    insert: sa.Insert,
+    data: T.List[dict],
+    minimal_size: int,
+    op_counter: int,
+    ins_counter: int,
+    rejected: T.Optional[T_REJECTED_SINK],
+) -> T.Tuple[int, int]:
+    """
+    The "one statement per chunk" implementation of :func:`smart_insert`,
+    the conflicted rows are skipped by the database. If ``rejected`` is
+    required, the inserted primary keys are found with ``RETURNING``, rows
+    without full primary key values (for example, auto increment id) can't be
+    matched and are never reported.
+
+    The chunk is split into multiple statements if it has more rows than
+    the dialect's bound parameter limit allows. ``ON CONFLICT DO NOTHING``
+    only skips unique key conflicts, if a statement fails with other
+    IntegrityError (NOT NULL, CHECK, FOREIGN KEY), its rows are sent through
+    :func:`_split_insert`.
+    """
+    connection = committer.conn
+    max_rows = get_max_rows_per_statement(connection.dialect, len(table.columns))
+    pk_cols = list(table.primary_key)
+    pk_names = [col.name for col in pk_cols]
+    normalize = get_pk_normalizer(pk_cols, connection.dialect)
+    for rows in grouper_list(data, max_rows):
+        try:
+            with committer.attempt():
+                if rejected is None:
+                    result = connection.execute(insert.values(rows))
+                    n_inserted = result.rowcount
+                else:
+                    result = connection.execute(insert.values(rows).returning(*pk_cols))
+                    inserted_pks = [tuple(row) for row in result]
+        except IntegrityError:
+            op_counter, ins_counter = _split_insert(
+                committer=committer,
+                table=table,
+                data=rows,
+                minimal_size=minimal_size,
+                op_counter=op_counter + 1,
+                ins_counter=ins_counter,
+                rejected=rejected,
+            )
+            continue
+        if rejected is not None:
+            n_inserted = len(inserted_pks)
+            inserted_pks = set(inserted_pks)
+            for row in rows:
+                pk = get_pk_value(pk_names, row)
+                if None in pk:  # generated by the database
+                    continue
+                pk = normalize(pk)
+                if pk in inserted_pks:
+                    inserted_pks.remove(pk)  # the duplicate rows after it are rejected
+                else:
+                    report_rejected(rejected, row)
+        committer.succeeded(n_inserted)
+        op_counter += 1
+        ins_counter += n_inserted
+    return op_counter, ins_counter
+
+
+def _partition_by_pk(
+    table: sa.Table,
+    data: T.List[dict],
+    n: int,
+) -> T.List[T.List[dict]]:
+    """
+    Partition rows by the hash of the primary key values, so rows with the same
+    primary key always go to the same partition. Rows without full primary key
+    values are distributed in round-robin.
+    """
+    pk_names = [col.name for col in table.primary_key]
+    partitions = [list() for _ in range(n)]
+    for i, row in enumerate(data):
+        pk = get_pk_value(pk_names, row)
+        if None in pk:
+            partitions[i % n].append(row)
+        else:
+            partitions[hash(pk) % n].append(row)
+    return partitions
 
 
 def smart_insert(
     engine: sa.Engine,
     table: sa.Table,
-    data: T.Union[dict, T.List[dict]],
+    data: T.Union[dict, T.Iterable[dict]],
     minimal_size: int = 5,
-    _connection: sa.Connection = None,
-    _op_counter: int = 0,
-    _ins_counter: int = 0,
-    _is_first_call: bool = True,
+    strategy: str = "split",
+    batch_size: T.Optional[int] = None,
+    prefilter: bool = False,
+    use_savepoint: bool = False,
+    commit_every: T.Optional[int] = None,
+    progress_callback: T.Optional[T.Callable[[int, int, int], T.Any]] = None,
+    sizer: T.Optional[AdaptiveBatchSizer] = None,
+    rejected: T.Optional[T_REJECTED_SINK] = None,
+    workers: int = 1,
 ) -> T.Tuple[int, int]:
     """
     An optimized Insert strategy. Guarantee successful and highest insertion
-    speed. But ATOMIC WRITE IS NOT ENSURED IF THE PROGRAM IS INTERRUPTED.
+    speed. But ATOMIC WRITE IS NOT ENSURED IF THE PROGRAM IS INTERRUPTED,
+    unless ``use_savepoint = True``.
+
+    :param data: a dict, a list of dict, or any iterable / generator of dict.
+        Iterator is consumed window by window, only one window is kept in memory.
+    :param minimal_size: in ``split`` strategy, if the failed chunk is smaller
+        than ``minimal_size ** 2``, insert rows one by one.
+    :param strategy: ``"split"`` (default), try bulk insert, if failed, split
+        the data into ``sqrt(n)`` chunks and repeat recursively.
+        ``"bisect"``, if failed, split the data into two halves and repeat
+        recursively, a half that succeeded is never re-sent.
+        ``"on_conflict"``, use the dialect native conflict skipping syntax, one
+        statement per chunk, fall back to ``"split"`` if the dialect doesn't
+        support it. A statement that fails with other IntegrityError
+        (NOT NULL, CHECK, FOREIGN KEY) is retried with ``"split"``. Note that
+        MySQL's ``INSERT IGNORE`` also silently coerces invalid values instead
+        of rejecting the row. ``"adaptive"``, grow or shrink the size of the next attempt
+        based on the observed IntegrityError rate and latency, see
+        :class:`AdaptiveBatchSizer`.
+    :param batch_size: number of rows in each bulk INSERT attempt (window).
+        None means send all rows in one attempt if ``data`` is a list, or
+        :data:`DEFAULT_WINDOW_SIZE` rows if ``data`` is an iterator. With
+        ``strategy="on_conflict"``, an iterator is read in windows that fill
+        one statement, and a window is sent with as few multi rows
+        statements as the dialect's bound parameter limit allows
+        (for example, 32766 in SQLite, 2100 in MSSQL).
+    :param prefilter: if True, before inserting each chunk, find out the primary
+        keys that already exist with one indexed SELECT, and drop those rows in
+        memory. Useful when most of the rows already exist.
+    :param use_savepoint: if True, run the whole operation in one outer
+        transaction, isolate each bulk INSERT attempt with ``SAVEPOINT``, and
+        commit only once at the end. The write is atomic.
+    :param commit_every: only works with ``use_savepoint = True``, commit the
+        outer transaction every time at least ``commit_every`` rows are inserted.
+    :param progress_callback: a function that called after each window with
+        the running totals ``(n_processed_rows, op_counter, ins_counter)``.
+    :param sizer: only works with ``strategy="adaptive"``, customize the
+        :class:`AdaptiveBatchSizer`.
+    :param rejected: where to send the rows that are not inserted, as
+        :class:`RejectedRow`. It can be a list, a callable, or a file writer
+        like :class:`JsonLinesRejectWriter`, :class:`CsvRejectWriter`.
+        With ``strategy="on_conflict"``,
+        the dialect has to support ``INSERT ... RETURNING``, otherwise it falls
+        back to ``"split"``.
+    :param workers: if more than 1, partition each window by the hash of the
+        primary key and insert the partitions concurrently on a thread pool,
+        one pooled connection per worker. Each worker commits its own
+        partition, so it can't be used with ``use_savepoint = True``. Ignored
+        with a warning on SQLite, which allows only one writer.
 
     :return: number of successful INSERT sql execution; number of inserted rows.
 
@@ -41,58 +713,318 @@ def smart_insert(
 
     该Insert策略在内存上需要额外的 sqrt(nbytes) 的开销, 跟原数据相比体积很小。
     但时间上是各种情况下平均最优的。
+
+    如果使用 ``strategy="on_conflict"``, 则每个包只用一条
+    ``INSERT ... ON CONFLICT DO NOTHING`` (MySQL 中是 ``INSERT IGNORE``) 语句,
+    冲突的行由数据库直接跳过, 不再需要回滚和分包. 对于不支持该语法的数据库, 自动
+    退回到 ``split`` 策略. 如果某条语句因为其他 IntegrityError (NOT NULL, CHECK,
+    外键) 失败, 则该语句中的行改用 ``split`` 策略重试. 注意 MySQL 的 ``INSERT IGNORE``
+    还会把非法的值静默地转换, 而不是拒绝该行.
+
+    如果使用 ``prefilter=True``, 则在插入每个包之前, 先用一次基于主键索引的查询找出
+    已经存在的主键, 并在内存中去掉这些行. 适用于绝大部分数据都已经存在的情况.
+
+    默认情况下每次成功的 Bulk Insert 都会 commit, 每次失败都会回滚整个事务. 如果使用
+    ``use_savepoint=True``, 则整个操作在一个事务中完成, 每次尝试都用 SAVEPOINT 隔离,
+    失败时只回滚到 SAVEPOINT, 最后只 commit 一次 (或者每 ``commit_every`` 行 commit
+    一次). 这样既减少了 commit 的开销, 也保证了写入的原子性.
+
+    ``data`` 可以是任何可迭代对象, 例如逐行解析一个巨大文件的生成器. 此时数据会被按照
+    ``batch_size`` 分成窗口依次处理, 内存中最多只有一个窗口的数据.
+
+    如果使用 ``strategy="adaptive"``, 则每次尝试的大小由 :class:`AdaptiveBatchSizer`
+    根据最近的冲突率和执行时间动态决定.
+
+    如果使用 ``strategy="bisect"``, 失败的包会被对半拆分, 成功的一半不会被重复发送.
+    在 n 行中找出 k 个冲突行大约只需要 O(k * log(n)) 条语句.
+
+    如果传入了 ``rejected``, 所有没有被插入的行都会以 :class:`RejectedRow` 的
+    形式 (包含原始数据以及数据库驱动的异常类) 被发送到该目标. 目标可以是一个列表,
+    一个函数, 或者是 :class:`JsonLinesRejectWriter`, :class:`CsvRejectWriter` 这样的
+    文件写入器. 调用者无需再次扫描数据源就能知道哪些行被拒绝了.
+
+    使用 ``strategy="on_conflict"`` 时, 每条多行 INSERT 语句的行数会根据数据库的绑定参数
+    上限 (例如 SQLite 为 32766, MSSQL 为 2100) 自动计算, 尽量用最少的语句写入一个窗口,
+    同时不会因为参数过多而报错.
+
+    如果使用 ``workers=N``, 每个窗口的数据会按照主键的哈希值分成 N 份, 在线程池中
+    并发插入, 每个线程使用连接池中独立的连接. 适用于受网络延迟限制的大批量导入.
+    每个线程独立 commit, 所以不能和 ``use_savepoint=True`` 一起使用. SQLite 只允许
+    一个写入者, 所以在 SQLite 中该参数会被忽略并给出警告.
     """
-    if _connection is None:
-        _connection = engine.connect()
+    if strategy not in _insert_strategies:
+        raise ValueError(f"invalid strategy {strategy!r}")
+    if workers > 1:
+        if use_savepoint:
+            raise ValueError(
+                "workers > 1 can't be used with use_savepoint = True, "
+                "each worker commits its own partition, the write is not atomic"
+            )
+        if engine.dialect.name == "sqlite":
+            warnings.warn(
+                "SQLite allows only one writer, workers is ignored",
+                stacklevel=2,
+            )
+            workers = 1
 
-    insert = table.insert()
+    if isinstance(data, dict):
+        data = [data]
+    if isinstance(data, (list, tuple)):
+        if batch_size is None:
+            chunks = [data] if len(data) else []
+        else:
+            chunks = grouper_list(data, batch_size)
+    else:
+        if batch_size is None:
+            if strategy == "on_conflict":
+                batch_size = get_max_rows_per_statement(
+                    engine.dialect, len(table.columns)
+                )
+            else:
+                batch_size = DEFAULT_WINDOW_SIZE
+        chunks = grouper_list(data, batch_size)
 
-    if isinstance(data, list):
-        # 首先进行尝试 bulk insert
-        try:
-            _connection.execute(insert, data)
-            _connection.commit()
-            _op_counter += 1
-            _ins_counter += len(data)
-        # 失败了
-        except IntegrityError:
-            _connection.rollback()
-            # 分析数据量
-            n = len(data)
-            # 如果数据条数多于一定数量
-            if n >= minimal_size**2:
-                # 则进行分包
-                n_chunk = math.floor(math.sqrt(n))
-                for chunk in grouper_list(data, n_chunk):
-                    _op_counter, _ins_counter = smart_insert(
-                        engine=engine,
-                        table=table,
-                        data=chunk,
-                        minimal_size=minimal_size,
-                        _connection=_connection,
-                        _op_counter=_op_counter,
-                        _ins_counter=_ins_counter,
-                        _is_first_call=False,
+    n_processed = 0
+    op_counter, ins_counter = 0, 0
+    if workers > 1:
+        kwargs = dict(
+            engine=engine,
+            table=table,
+            minimal_size=minimal_size,
+            strategy=strategy,
+            prefilter=prefilter,
+            use_savepoint=use_savepoint,
+            commit_every=commit_every,
+            rejected=rejected,
+        )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk in chunks:
+                n_processed += len(chunk)
+                futures = [
+                    executor.submit(
+                        smart_insert,
+                        data=partition,
+                        sizer=copy.copy(sizer),
+                        **kwargs,
                     )
-            # 否则则一条条地逐条插入
+                    for partition in _partition_by_pk(table, chunk, workers)
+                    if len(partition)
+                ]
+                for future in futures:
+                    op, ins = future.result()
+                    op_counter += op
+                    ins_counter += ins
+                if progress_callback is not None:
+                    progress_callback(n_processed, op_counter, ins_counter)
+        return op_counter, ins_counter
+
+    with engine.connect() as connection:
+        committer = BatchCommitter(
+            connection,
+            use_savepoint=use_savepoint,
+            commit_every=commit_every,
+        )
+        insert = None
+        if strategy == "on_conflict":
+            if rejected is None or connection.dialect.insert_returning:
+                insert = get_on_conflict_do_nothing_insert(table, connection.dialect)
+        elif strategy == "adaptive":
+            if sizer is None:
+                sizer = AdaptiveBatchSizer()
+
+        for chunk in chunks:
+            n_processed += len(chunk)
+            if prefilter:
+                chunk = _drop_existing_rows(connection, table, chunk, rejected)
+            kwargs = dict(
+                committer=committer,
+                table=table,
+                data=chunk,
+                op_counter=op_counter,
+                ins_counter=ins_counter,
+                rejected=rejected,
+            )
+            if len(chunk) == 0:
+                pass
+            elif strategy == "adaptive":
+                op_counter, ins_counter = _adaptive_insert(
+                    minimal_size=minimal_size, sizer=sizer, **kwargs
+                )
+            elif strategy == "bisect":
+                op_counter, ins_counter = _bisect_insert(**kwargs)
+            elif insert is None:
+                op_counter, ins_counter = _split_insert(
+                    minimal_size=minimal_size, **kwargs
+                )
             else:
-                for row in data:
-                    try:
-                        _connection.execute(insert.values(**row))
-                        _connection.commit()
-                        _op_counter += 1
-                        _ins_counter += 1
-                    except IntegrityError:
-                        _connection.rollback()
+                op_counter, ins_counter = _on_conflict_insert(
+                    insert=insert, minimal_size=minimal_size, **kwargs
+                )
+            if progress_callback is not None:
+                progress_callback(n_processed, op_counter, ins_counter)
+        committer.finish()
+    return op_counter, ins_counter
+
+
+def _to_copy_csv_value(value: T.Any) -> str:
+    """
+    Encode a python value as a field in PostgreSQL ``COPY ... (FORMAT csv)``.
+    None is encoded as unquoted empty string (NULL), all other values are
+    quoted, so empty string is not NULL.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        text = "\\x" + bytes(value).hex()
+    elif isinstance(value, (dict, list)):
+        text = json.dumps(value)
+    elif hasattr(value, "isoformat"):  # date, time, datetime
+        text = value.isoformat()
     else:
-        try:
-            _connection.execute(insert, data)
-            _connection.commit()
-            _op_counter += 1
-            _ins_counter += 1
-        except IntegrityError:
-            _connection.rollback()
+        text = str(value)
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _to_copy_csv_lines(
+    rows: T.Iterable[dict],
+    columns: T.List[str],
+) -> T.Iterable[str]:
+    for row in rows:
+        yield ",".join([_to_copy_csv_value(row.get(c)) for c in columns]) + "\n"
+
+
+class _LineStream(io.TextIOBase):
+    """
+    A read only text stream over an iterable of lines, the lines are generated
+    lazily when the driver reads the stream.
+    """
+
+    def __init__(self, lines: T.Iterable[str]):
+        self._lines = iter(lines)
+        self._buffer = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        text, self._buffer = self._buffer[:size], self._buffer[size:]
+        return text
+
+
+def _copy_from_lines(
+    connection: sa.Connection,
+    sql: str,
+    lines: T.Iterable[str],
+):
+    """
+    Run ``COPY ... FROM STDIN`` with the DBAPI driver specific API.
+    """
+    driver = connection.dialect.driver
+    cursor = connection.connection.cursor()
+    try:
+        if driver == "psycopg2":
+            cursor.copy_expert(sql, _LineStream(lines))
+        elif driver == "pg8000":
+            cursor.execute(sql, stream=lines)
+        elif driver == "psycopg":
+            with cursor.copy(sql) as copy_:
+                for line in lines:
+                    copy_.write(line)
+        else:  # pragma: no cover
+            raise NotImplementedError(
+                f"COPY is not supported for the {driver!r} driver"
+            )
+    finally:
+        cursor.close()
+
+
+def bulk_copy(
+    engine: sa.Engine,
+    table: sa.Table,
+    rows: T.Iterable[dict],
+    columns: T.Optional[T.List[str]] = None,
+    on_conflict_do_nothing: bool = False,
+) -> int:
+    """
+    Bulk load rows into a PostgreSQL table with ``COPY ... FROM STDIN``, which
+    is much faster than executemany INSERT. Rows are streamed to the server
+    in CSV format, the full data is never buffered in memory. Supports
+    the ``psycopg2``, ``pg8000`` and ``psycopg`` driver.
+
+    :param rows: any iterable / generator of dict. The values have to be the
+        database level values, for example, custom type is not processed.
+    :param columns: the columns to load, by default it is the keys of the first
+        row. Missing key is loaded as NULL.
+    :param on_conflict_do_nothing: if True, load rows into a temporary staging
+        table, then ``INSERT ... SELECT ... ON CONFLICT DO NOTHING`` into the
+        target table. It can replace :func:`smart_insert` for deduplicating
+        loads.
+
+    :return: number of inserted rows.
+
+    **中文文档**
+
+    使用 PostgreSQL 的 ``COPY FROM STDIN`` 批量导入数据, 速度远远快于 executemany
+    INSERT. 数据以 CSV 的形式流式发送, 不会在内存中生成完整的缓存. 如果使用
+    ``on_conflict_do_nothing=True``, 则先将数据导入一个临时表, 然后用
+    ``INSERT ... SELECT ... ON CONFLICT DO NOTHING`` 写入目标表, 冲突的行会被跳过.
+    """
+    if engine.dialect.name != "postgresql":
+        raise NotImplementedError("bulk_copy only supports PostgreSQL")
+
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return 0
+    if columns is None:
+        columns = list(first_row)
+    rows = itertools.chain([first_row], rows)
+
+    n_rows = 0
+
+    def count(rows_):
+        nonlocal n_rows
+        for row in rows_:
+            n_rows += 1
+            yield row
+
+    preparer = engine.dialect.identifier_preparer
+    column_list = ", ".join([preparer.quote(c) for c in columns])
+    with engine.begin() as connection:
+        if on_conflict_do_nothing:
+            from sqlalchemy.dialects.postgresql import insert
+
+            staging_name = f"_staging_{table.name}_{uuid.uuid4().hex[:8]}"
+            connection.exec_driver_sql(
+                f"CREATE TEMPORARY TABLE {preparer.quote(staging_name)} "
+                f"(LIKE {preparer.format_table(table)} INCLUDING DEFAULTS) "
+                f"ON COMMIT DROP"
+            )
+            staging_table = sa.Table(
+                staging_name,
+                sa.MetaData(),
+                *[sa.Column(c, table.c[c].type) for c in columns],
+            )
+            target = preparer.format_table(staging_table)
+        else:
+            target = preparer.format_table(table)
+
+        sql = f"COPY {target} ({column_list}) FROM STDIN WITH (FORMAT csv)"
+        _copy_from_lines(connection, sql, _to_copy_csv_lines(count(rows), columns))
 
-    if _is_first_call:
-        _connection.close()
-    return _op_counter, _ins_counter
+        if on_conflict_do_nothing:
+            stmt = (
+                insert(table)
+                .from_select(columns, sa.select(staging_table))
+                .on_conflict_do_nothing()
+            )
+            return connection.execute(stmt).rowcount
+        else:
+            return n_rows
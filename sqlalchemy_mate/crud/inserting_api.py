@@ -1,3 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from .inserting import smart_insert
+from .inserting import get_on_conflict_do_nothing_insert
+from .inserting import AdaptiveBatchSizer
+from .inserting import RejectedRow
+from .inserting import JsonLinesRejectWriter
+from .inserting import CsvRejectWriter
+from .inserting import bulk_copy
@@ -4,20 +4,125 @@
 This module provide utility functions for select operation.
 """
 
+import time
+import random
+import weakref
+import threading
 import typing as T
+from collections import OrderedDict
 
 import sqlalchemy as sa
 
-from ..utils import ensure_exact_one_arg_is_not_none
+from ..utils import (
+    ensure_exact_one_arg_is_not_none,
+    grouper_list,
+    get_max_rows_per_statement,
+    get_pk_normalizer,
+    pk_in_clause,
+    select_rows_by_pks,
+)
+
+
+def _approximate_count(
+    connection: sa.Connection,
+    table: sa.Table,
+) -> T.Optional[int]:
+    """
+    Read the estimated number of rows from the planner statistics, without
+    scanning the table. Return None if the statistics is not available.
+
+    - PostgreSQL: ``pg_class.reltuples``, -1 means never analyzed.
+    - MySQL: ``information_schema.tables.table_rows``.
+    - SQLite: the first number of ``sqlite_stat1.stat``, need ``ANALYZE``.
+    """
+    dialect_name = connection.dialect.name
+    if dialect_name == "postgresql":
+        name = connection.dialect.identifier_preparer.format_table(table)
+        value = connection.execute(
+            sa.text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"),
+            {"name": name},
+        ).scalar()
+        if value is None or value < 0:
+            return None
+        return int(value)
+    elif dialect_name in ("mysql", "mariadb"):
+        value = connection.execute(
+            sa.text(
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = COALESCE(:schema, DATABASE()) "
+                "AND table_name = :name"
+            ),
+            {"schema": table.schema, "name": table.name},
+        ).scalar()
+        return None if value is None else int(value)
+    elif dialect_name == "sqlite":
+        # sqlite_stat1 only exists after the first ANALYZE
+        if not sa.inspect(connection).has_table("sqlite_stat1"):
+            return None
+        value = connection.execute(
+            sa.text("SELECT stat FROM sqlite_stat1 WHERE tbl = :name"),
+            {"name": table.name},
+        ).scalar()
+        return None if value is None else int(value.split()[0])
+    else:
+        return None
+
+
+# engine -> {(table fullname, approximate): (cached at, count)}, the entries go
+# away with the engine
+_count_cache = weakref.WeakKeyDictionary()
+_count_cache_lock = threading.Lock()
+
+
+def _count_row(
+    connection: sa.Connection,
+    table: sa.Table,
+    approximate: bool = False,
+    cache_ttl: T.Optional[float] = None,
+) -> int:
+    """
+    The implementation of :func:`count_row` on an existing connection.
+    """
+    if cache_ttl is not None:
+        engine = connection.engine
+        key = (table.fullname, approximate)
+        with _count_cache_lock:
+            cached = _count_cache.get(engine, dict()).get(key)
+        if (cached is not None) and (time.monotonic() - cached[0] < cache_ttl):
+            return cached[1]
+
+    count = None
+    if approximate:
+        count = _approximate_count(connection, table)
+    if count is None:
+        count = connection.execute(
+            sa.select(sa.func.count()).select_from(table)
+        ).fetchone()[0]
+
+    if cache_ttl is not None:
+        with _count_cache_lock:
+            _count_cache.setdefault(engine, dict())[key] = (time.monotonic(), count)
+    return count
 
 
 def count_row(
     engine: sa.Engine,
     table: sa.Table,
+    approximate: bool = False,
+    cache_ttl: T.Optional[float] = None,
 ) -> int:
     """
     Return number of rows in a table.
 
+    :param approximate: if True, read the estimated number of rows from the
+        planner statistics (PostgreSQL ``pg_class.reltuples``, MySQL
+        ``information_schema.tables.table_rows``, SQLite ``sqlite_stat1``)
+        instead of ``SELECT count(*)``, which is a full scan on big tables.
+        Fall back to the exact count if the statistics is not available.
+    :param cache_ttl: if given, cache the count in memory for ``cache_ttl``
+        seconds, useful for dashboards that poll frequently. The cache is
+        per engine and thread safe, it is dropped with the engine.
+
     Example::
 
         import sqlalchemy as sa
@@ -26,15 +131,20 @@ def count_row(
         t_users = sa.Table(...)
         engine = sa.create_engine(...)
         sam.selecting.count_row(engine, t_user)
+        sam.selecting.count_row(engine, t_user, approximate=True)
 
     **中文文档**
 
     返回一个表中的行数。
+
+    如果使用 ``approximate=True``, 则从数据库的统计信息中读取估计的行数, 无需全表扫描.
+    如果没有统计信息, 则退回到精确计数. 如果指定了 ``cache_ttl``, 则计数结果会在内存中
+    缓存 ``cache_ttl`` 秒. 缓存按 engine 隔离, 线程安全, 并随 engine 一起被回收.
     """
     with engine.connect() as connection:
-        return connection.execute(
-            sa.select(sa.func.count()).select_from(table)
-        ).fetchone()[0]
+        return _count_row(
+            connection, table, approximate=approximate, cache_ttl=cache_ttl
+        )
 
 
 def by_pk(
@@ -80,35 +190,283 @@ def by_pk(
             return connection.execute(stmt).fetchone()
 
 
+class SelectionHandle:
+    """
+    Own one connection and the result of one query for the lifetime of the
+    iteration, and return the connection to the pool deterministically when
+    the ``with`` block exits, instead of buffering the whole result or
+    reading from a closed connection.
+
+    :param engine: the engine to check out the connection from.
+    :param stmt: the query, :class:`sqlalchemy.Select` or
+        :class:`sqlalchemy.TextClause`.
+    :param parameters: optional bound parameters of the query.
+    :param execution_options: optional execution options of the query.
+    :param yield_per: if given, stream the result with a server side cursor
+        (``stream_results=True``), only ``yield_per`` rows are buffered in
+        client memory at a time.
+    :param transform: optional function applied to each row yielded by
+        iteration, :meth:`fetchmany` and :meth:`partitions`, for example
+        ``tuple``. :meth:`tuples` and :meth:`dicts` always use the raw rows.
+
+    Example::
+
+        stmt = sa.select(t_users)
+        with sam.selecting.SelectionHandle(engine, stmt, yield_per=1000) as handle:
+            for rows in handle.partitions():
+                ...
+
+        # iterate without ``with``, the connection is released when
+        # the loop ends
+        for row in sam.selecting.SelectionHandle(engine, stmt):
+            ...
+
+    **中文文档**
+
+    在迭代期间持有一个数据库连接和查询结果, 在 ``with`` 语句结束时确定性地把连接
+    归还给连接池. 这样大的查询可以用服务端游标流式读取, 既不需要把结果全部缓存到
+    内存中, 也不会从已经关闭的连接上读取数据或者泄漏连接.
+    """
+
+    def __init__(
+        self,
+        engine: sa.Engine,
+        stmt: T.Union[sa.Select, sa.TextClause],
+        parameters: T.Optional[T.Union[dict, T.List[dict]]] = None,
+        execution_options: T.Optional[dict] = None,
+        yield_per: T.Optional[int] = None,
+        transform: T.Optional[T.Callable[[sa.Row], T.Any]] = None,
+    ):
+        self.engine = engine
+        self.stmt = stmt
+        self.parameters = parameters
+        self.execution_options = execution_options
+        self.yield_per = yield_per
+        self.transform = transform
+        self._connection: T.Optional[sa.Connection] = None
+        self._result: T.Optional[sa.Result] = None
+
+    @property
+    def closed(self) -> bool:
+        return self._connection is None
+
+    def open(self) -> "SelectionHandle":
+        """
+        Check out a connection and execute the query, do nothing if it is
+        already open.
+        """
+        if self._connection is None:
+            stmt = self.stmt
+            if self.yield_per is not None:
+                stmt = stmt.execution_options(
+                    stream_results=True, yield_per=self.yield_per
+                )
+            connection = self.engine.connect()
+            try:
+                self._result = connection.execute(
+                    stmt,
+                    self.parameters,
+                    execution_options=self.execution_options,
+                )
+            except Exception:
+                connection.close()
+                raise
+            self._connection = connection
+        return self
+
+    def close(self):
+        """
+        Discard the unread rows and return the connection to the pool.
+        """
+        if self._result is not None:
+            self._result.close()
+            self._result = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self) -> "SelectionHandle":
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def result(self) -> sa.Result:
+        """
+        The underlying :class:`sqlalchemy.Result`.
+        """
+        if self._result is None:
+            raise RuntimeError(
+                "SelectionHandle is not open, use it in a ``with`` statement"
+            )
+        return self._result
+
+    def keys(self) -> T.List[str]:
+        return list(self.result.keys())
+
+    def __iter__(self) -> T.Iterable[T.Any]:
+        auto_close = self.closed
+        self.open()
+        try:
+            if self.transform is None:
+                yield from self._result
+            else:
+                for row in self._result:
+                    yield self.transform(row)
+        finally:
+            if auto_close:
+                self.close()
+
+    def fetchmany(self, size: T.Optional[int] = None) -> T.List[T.Any]:
+        """
+        Fetch the next ``size`` rows, return an empty list when exhausted.
+        """
+        rows = self.result.fetchmany(size)
+        if self.transform is None:
+            return rows
+        return [self.transform(row) for row in rows]
+
+    def partitions(self, size: T.Optional[int] = None) -> T.Iterable[T.List[T.Any]]:
+        """
+        Yield list of rows, ``size`` rows at a time, by default ``yield_per``.
+        """
+        for rows in self.result.partitions(size):
+            if self.transform is None:
+                yield rows
+            else:
+                yield [self.transform(row) for row in rows]
+
+    def tuples(self) -> T.Iterable[tuple]:
+        """
+        Yield rows in tuple values view.
+        """
+        return yield_tuple(self.result)
+
+    def dicts(self) -> T.Iterable[dict]:
+        """
+        Yield rows in dict view.
+        """
+        return yield_dict(self.result)
+
+
+def _buffer(result: sa.Result) -> sa.Result:
+    """
+    Fetch all rows into memory, so the returned result is still readable
+    after its connection is returned to the pool.
+    """
+    return result.freeze()()
+
+
+def _normalize_pk_value(
+    n_pk: int,
+    id_,
+) -> tuple:
+    """
+    Convert the primary key value in user input, single value or tuple / list
+    of values, into tuple.
+    """
+    if isinstance(id_, (tuple, list)):
+        if len(id_) != n_pk:
+            raise ValueError(f"expect {n_pk} primary key values, got {id_!r}")
+        return tuple(id_)
+    else:
+        if n_pk != 1:
+            raise ValueError(f"expect {n_pk} primary key values, got {id_!r}")
+        return (id_,)
+
+
+def by_pks(
+    engine: sa.Engine,
+    table: sa.Table,
+    ids: T.Iterable[T.Any],
+) -> T.Dict[T.Any, T.Optional[sa.Row]]:
+    """
+    Return many rows by primary key values with a few
+    ``SELECT ... WHERE pk IN (...)`` queries in one connection. Keys are
+    chunked to the dialect's bound parameter limit, tuple IN is used for
+    composite primary key.
+
+    :param ids: list of primary key values, each item has the same format as
+        the ``id_`` argument of :func:`by_pk`.
+
+    :return: an ordered dict, key is the primary key value as given (list is
+        converted to tuple), value is the row, or None if not found. The order
+        is the same as ``ids``.
+
+    Example::
+
+        rows = sam.selecting.by_pks(engine, t_user, [1, 2, 3])
+        rows[1]  # Row or None
+
+    **中文文档**
+
+    根据多个主键值批量获取行. 主键值会根据数据库的绑定参数上限分块, 每块只需要一次
+    ``IN (...)`` 查询, 复合主键使用 tuple IN. 返回一个按照输入顺序排列的字典, 找不到
+    的主键对应的值为 None.
+    """
+    n_pk = len(table.primary_key)
+    # match the input values with what the database returns, e.g. "1" -> 1
+    normalize = get_pk_normalizer(list(table.primary_key), engine.dialect)
+    keys = OrderedDict()
+    for id_ in ids:
+        key = tuple(id_) if isinstance(id_, list) else id_
+        keys[key] = normalize(_normalize_pk_value(n_pk, id_))
+    with engine.connect() as connection:
+        found = select_rows_by_pks(connection, table, list(set(keys.values())))
+    return OrderedDict([(key, found.get(pk)) for key, pk in keys.items()])
+
+
 def select_all(
     engine: sa.Engine,
     table: sa.Table,
-) -> sa.Result:
+    yield_per: T.Optional[int] = None,
+) -> T.Union[sa.Result, SelectionHandle]:
     """
     Select all rows from a table.
 
+    :param yield_per: if given, return a :class:`SelectionHandle` that streams
+        the rows with a server side cursor (``stream_results=True``), only
+        ``yield_per`` rows are buffered in client memory at a time. Otherwise
+        all rows are fetched into a buffered result before the connection is
+        returned to the pool.
+
     Example::
 
         for row in sam.selecting.select_all(engine, t_users):
             ...
+
+        with sam.selecting.select_all(engine, t_users, yield_per=1000) as handle:
+            for rows in handle.partitions():
+                ...
     """
     s = sa.select(table)
+    if yield_per is not None:
+        return SelectionHandle(engine, s, yield_per=yield_per)
     with engine.connect() as connection:
-        return connection.execute(s)
+        return _buffer(connection.execute(s))
 
 
 def select_single_column(
     engine: sa.Engine,
     column: sa.Column,
-) -> list:
+    yield_per: T.Optional[int] = None,
+) -> T.Union[list, SelectionHandle]:
     """
     Select data from single column.
 
+    :param yield_per: if given, return a :class:`SelectionHandle` that streams
+        the values instead of list, see :func:`select_all`.
+
     Example::
 
         id_list = sam.selecting.select_all(engine, t_users.c.id)
     """
     s = sa.select(column)
+    if yield_per is not None:
+        return SelectionHandle(
+            engine, s, yield_per=yield_per, transform=lambda row: row[0]
+        )
     with engine.connect() as connection:
         return [row[0] for row in connection.execute(s)]
 
@@ -116,15 +474,21 @@ def select_single_column(
 def select_many_column(
     engine: sa.Engine,
     columns: T.List[sa.Column],
-) -> T.List[tuple]:
+    yield_per: T.Optional[int] = None,
+) -> T.Union[T.List[tuple], SelectionHandle]:
     """
     Select data from multiple columns.
 
+    :param yield_per: if given, return a :class:`SelectionHandle` that streams
+        the values instead of list, see :func:`select_all`.
+
     Example::
 
         dataframe = sam.selecting.select_all(engine, [t_users.c.id, t_users.c.name])
     """
     s = sa.select(*columns)
+    if yield_per is not None:
+        return SelectionHandle(engine, s, yield_per=yield_per, transform=tuple)
     with engine.connect() as connection:
         return [tuple(row) for row in connection.execute(s)]
 
@@ -132,19 +496,215 @@ def select_many_column(
 def select_single_distinct(
     engine: sa.Engine,
     column: sa.Column,
-) -> list:
+    yield_per: T.Optional[int] = None,
+) -> T.Union[list, SelectionHandle]:
     """
     Select distinct data from single column.
 
+    :param yield_per: if given, return a :class:`SelectionHandle` that streams
+        the values instead of list, see :func:`select_all`.
+
     Example::
 
         unique_name_list = sam.selecting.select_all(engine, t_users.c.name)
     """
     s = sa.select(column).distinct()
+    if yield_per is not None:
+        return SelectionHandle(
+            engine, s, yield_per=yield_per, transform=lambda row: row[0]
+        )
     with engine.connect() as connection:
         return [row[0] for row in connection.execute(s)]
 
 
+def _numpy_dtype(type_: sa.types.TypeEngine) -> str:
+    """
+    Pick the NumPy dtype for a SQLAlchemy column type.
+    """
+    if isinstance(type_, sa.Boolean):
+        return "bool"
+    elif isinstance(type_, sa.Integer):
+        return "int64"
+    elif isinstance(type_, sa.Float):
+        return "float64"
+    elif isinstance(type_, sa.Numeric) and not type_.asdecimal:
+        return "float64"
+    elif isinstance(type_, sa.DateTime):
+        return "datetime64[us]"
+    elif isinstance(type_, sa.Date):
+        return "datetime64[D]"
+    else:
+        return "object"
+
+
+def _arrow_type(type_: sa.types.TypeEngine):
+    """
+    Pick the Arrow data type for a SQLAlchemy column type, None means infer
+    it from the data.
+    """
+    import pyarrow as pa
+
+    if isinstance(type_, sa.Boolean):
+        return pa.bool_()
+    elif isinstance(type_, sa.Integer):
+        return pa.int64()
+    elif isinstance(type_, sa.Float):
+        return pa.float64()
+    elif isinstance(type_, sa.Numeric):
+        if not type_.asdecimal:
+            return pa.float64()
+        elif type_.precision is None:
+            return None
+        elif type_.precision <= 38:
+            return pa.decimal128(type_.precision, type_.scale or 0)
+        else:
+            return pa.decimal256(type_.precision, type_.scale or 0)
+    elif isinstance(type_, sa.String):
+        return pa.string()
+    elif isinstance(type_, sa.LargeBinary):
+        return pa.binary()
+    elif isinstance(type_, sa.DateTime):
+        return pa.timestamp("us")
+    elif isinstance(type_, sa.Date):
+        return pa.date32()
+    elif isinstance(type_, sa.Time):
+        return pa.time64("us")
+    else:
+        return None
+
+
+def _arrow_chunked_array(chunks: list, type_):
+    """
+    Concatenate the Arrow chunks of a column. If the type is inferred from the
+    data, each chunk may get a different type (for example, the precision of
+    an unbounded decimal), then the type is inferred again from all values.
+    """
+    import pyarrow as pa
+
+    if type_ is None:
+        inferred_types = {chunk.type for chunk in chunks} - {pa.null()}
+        if len(inferred_types) == 0:
+            type_ = pa.null()
+        elif len(inferred_types) == 1:
+            type_ = inferred_types.pop()
+        else:
+            values = [value for chunk in chunks for value in chunk.to_pylist()]
+            return pa.chunked_array([pa.array(values)])
+    return pa.chunked_array(
+        [chunk if chunk.type == type_ else chunk.cast(type_) for chunk in chunks],
+        type=type_,
+    )
+
+
+class _NumpyColumnBuilder:
+    """
+    Fill a preallocated typed NumPy array chunk by chunk, the capacity is
+    doubled when it is full. If a NULL shows up in a column whose dtype
+    can't represent it (int, bool), the array is converted to object dtype.
+    """
+
+    def __init__(self, dtype: str, capacity: int):
+        import numpy as np
+
+        self.np = np
+        self.array = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values: tuple):
+        n = len(values)
+        if self.size + n > len(self.array):
+            capacity = max(self.size + n, 2 * len(self.array))
+            array = self.np.empty(capacity, dtype=self.array.dtype)
+            array[: self.size] = self.array[: self.size]
+            self.array = array
+        if (self.array.dtype.kind in "biu") and (None in values):
+            self.array = self.array.astype(object)
+        self.array[self.size : self.size + n] = values
+        self.size += n
+
+    def build(self):
+        return self.array[: self.size].copy()
+
+
+def select_columnar(
+    engine: sa.Engine,
+    columns: T.List[sa.Column],
+    as_: str = "numpy",
+    chunk_size: int = 10000,
+    where: T.Optional[sa.ColumnElement] = None,
+) -> T.Union[T.Dict[str, T.Any], "pyarrow.Table"]:
+    """
+    Select data from multiple columns in columnar layout, without the per row
+    tuple overhead. Rows are streamed ``chunk_size`` rows at a time and each
+    column is filled into a typed array, the dtype is picked from the column
+    type.
+
+    :param as_: the output format.
+
+        - ``"numpy"``: dict of column name to :class:`numpy.ndarray`. Integer
+          and boolean columns with NULL become object arrays.
+        - ``"arrow"``: :class:`pyarrow.Table`, NULL is supported natively.
+        - ``"dict_of_lists"``: dict of column name to list, no extra dependency.
+    :param chunk_size: number of rows fetched each time.
+    :param where: optional filter.
+
+    Example::
+
+        arrays = sam.selecting.select_columnar(
+            engine, [t_users.c.id, t_users.c.score], as_="numpy"
+        )
+        arrays["score"].mean()
+
+    **中文文档**
+
+    以列式布局返回多列数据. 数据按照 ``chunk_size`` 分块流式读取, 每一列被填入一个
+    根据列类型决定 dtype 的数组中, 避免了每一行都创建一个 tuple 的内存开销.
+    ``numpy`` 和 ``pyarrow`` 是可选依赖.
+    """
+    if as_ not in ("numpy", "arrow", "dict_of_lists"):
+        raise ValueError(f"invalid as_ {as_!r}")
+
+    names = [column.name for column in columns]
+    if as_ == "numpy":
+        builders = [
+            _NumpyColumnBuilder(_numpy_dtype(column.type), chunk_size)
+            for column in columns
+        ]
+    elif as_ == "arrow":
+        import pyarrow as pa
+
+        types = [_arrow_type(column.type) for column in columns]
+        arrays = [list() for _ in columns]
+    else:
+        lists = [list() for _ in columns]
+
+    stmt = sa.select(*columns)
+    if where is not None:
+        stmt = stmt.where(where)
+    stmt = stmt.execution_options(stream_results=True, yield_per=chunk_size)
+    with engine.connect() as connection:
+        for rows in connection.execute(stmt).partitions():
+            for i, values in enumerate(zip(*rows)):
+                if as_ == "numpy":
+                    builders[i].extend(values)
+                elif as_ == "arrow":
+                    arrays[i].append(pa.array(values, type=types[i]))
+                else:
+                    lists[i].extend(values)
+
+    if as_ == "numpy":
+        return {name: builder.build() for name, builder in zip(names, builders)}
+    elif as_ == "arrow":
+        return pa.table(
+            {
+                name: _arrow_chunked_array(chunks, type_)
+                for name, chunks, type_ in zip(names, arrays, types)
+            }
+        )
+    else:
+        return dict(zip(names, lists))
+
+
 def select_many_distinct(
     engine: sa.Engine,
     columns: T.List[sa.Column],
@@ -161,17 +721,275 @@ def select_many_distinct(
         return [tuple(row) for row in connection.execute(s)]
 
 
+_sampling_strategies = {
+    "order_by_random",
+    "pk_range",
+    "tablesample_system",
+    "tablesample_bernoulli",
+    "reservoir",
+}
+
+# below this many rows, TABLESAMPLE SYSTEM is too coarse for ``perc`` sampling
+_system_sample_min_rows = 100000
+
+
+def _random_func(dialect: sa.Dialect) -> sa.FunctionElement:
+    if dialect.name in ("mysql", "mariadb"):
+        return sa.func.rand()
+    return sa.func.random()
+
+
+def _has_integer_pk(table: sa.Table) -> bool:
+    pk_cols = list(table.primary_key)
+    return len(pk_cols) == 1 and isinstance(pk_cols[0].type, sa.Integer)
+
+
+def _choose_sampling_strategy(
+    connection: sa.Connection,
+    table: sa.Table,
+    perc: T.Optional[int] = None,
+) -> str:
+    """
+    Pick the sampling strategy that fits the dialect and the table.
+
+    - ``perc`` on PostgreSQL: ``TABLESAMPLE SYSTEM`` on big tables,
+      ``TABLESAMPLE BERNOULLI`` otherwise.
+    - single integer primary key: ``pk_range``.
+    - PostgreSQL: ``tablesample_system``.
+    - SQLite: ``reservoir``.
+    - anything else: ``order_by_random``.
+    """
+    dialect_name = connection.dialect.name
+    if (perc is not None) and (dialect_name == "postgresql"):
+        n_row = _approximate_count(connection, table)
+        if (n_row is not None) and (n_row >= _system_sample_min_rows):
+            return "tablesample_system"
+        return "tablesample_bernoulli"
+    if len(table.primary_key) == 0:
+        return "order_by_random"
+    if _has_integer_pk(table):
+        return "pk_range"
+    if dialect_name == "postgresql":
+        return "tablesample_system"
+    if dialect_name == "sqlite":
+        return "reservoir"
+    return "order_by_random"
+
+
+def _ensure_sampling_strategy(table: sa.Table, strategy: str):
+    if strategy not in _sampling_strategies:
+        raise ValueError(
+            f"strategy has to be one of {sorted(_sampling_strategies)}, "
+            f"got {strategy!r}"
+        )
+    if strategy in ("pk_range", "reservoir") and len(table.primary_key) == 0:
+        raise ValueError(f"table {table.name!r} has no primary key")
+    if strategy == "pk_range" and not _has_integer_pk(table):
+        raise ValueError(
+            f"strategy 'pk_range' requires a single integer primary key, "
+            f"table {table.name!r} doesn't have one"
+        )
+
+
+def _tablesample(table: sa.Table, strategy: str, perc: float) -> sa.TableSample:
+    method = sa.func.system if strategy == "tablesample_system" else sa.func.bernoulli
+    return table.tablesample(method(perc), name="alias", seed=sa.func.random())
+
+
+def _perc_to_limit(connection: sa.Connection, table: sa.Table, perc: int) -> int:
+    """
+    Convert ``perc`` to a number of rows with the estimated row count from the
+    planner statistics, fall back to the exact count if there is no statistics.
+    """
+    n_row = _count_row(connection, table, approximate=True)
+    return int(round(n_row * perc / 100))
+
+
+def _sample_pks_by_order(
+    connection: sa.Connection,
+    table: sa.Table,
+    limit: int,
+) -> T.List[tuple]:
+    pk_cols = list(table.primary_key)
+    stmt = sa.select(*pk_cols).order_by(_random_func(connection.dialect)).limit(limit)
+    return [tuple(row) for row in connection.execute(stmt)]
+
+
+def _sample_pks_by_range(
+    connection: sa.Connection,
+    table: sa.Table,
+    limit: int,
+    max_rounds: int = 8,
+) -> T.List[tuple]:
+    """
+    Draw random integers in ``[min(pk), max(pk)]`` and keep the ones that
+    exist, draw again for the misses. Each round is one indexed
+    ``pk IN (...)`` lookup, the next round oversamples by the observed hit
+    rate. Fall back to ``ORDER BY random()`` if the primary key
+    is too sparse.
+    """
+    pk_col = list(table.primary_key)[0]
+    lo, hi = connection.execute(
+        sa.select(sa.func.min(pk_col), sa.func.max(pk_col))
+    ).one()
+    if (lo is None) or (limit <= 0):
+        return list()
+    span = hi - lo + 1
+    chunk_size = get_max_rows_per_statement(connection.dialect, 1)
+
+    found = list()
+    tried = set()
+    hit_rate = 1.0
+    for _ in range(max_rounds):
+        need = limit - len(found)
+        if (need <= 0) or (len(tried) >= span):
+            break
+        n_draw = min(span - len(tried), int(need / max(hit_rate, 0.01) * 1.2) + 1)
+        # at most len(tried) of them are drawn before
+        pool = random.sample(range(lo, hi + 1), min(span, n_draw + len(tried)))
+        candidates = [value for value in pool if value not in tried][:n_draw]
+        tried.update(candidates)
+        hits = list()
+        for chunk in grouper_list(candidates, chunk_size):
+            hits.extend(
+                connection.execute(sa.select(pk_col).where(pk_col.in_(chunk))).scalars()
+            )
+        hit_rate = len(hits) / len(candidates)
+        random.shuffle(hits)
+        found.extend([(value,) for value in hits[:need]])
+
+    if (len(found) < limit) and (len(tried) < span):
+        return _sample_pks_by_order(connection, table, limit)
+    return found
+
+
+def _sample_pks_by_tablesample(
+    connection: sa.Connection,
+    table: sa.Table,
+    limit: int,
+    strategy: str,
+) -> T.List[tuple]:
+    """
+    Read about twice the wanted number of rows with ``TABLESAMPLE``, the
+    percentage comes from the planner statistics, then pick ``limit`` rows
+    from the sample. Fall back to ``ORDER BY random()`` if there is no
+    statistics or the sample is too small.
+    """
+    n_row = _approximate_count(connection, table)
+    if n_row:
+        perc = limit * 2.0 / n_row * 100
+        if perc < 100:
+            selectable = _tablesample(table, strategy, perc)
+            stmt = (
+                sa.select(*[selectable.c[col.name] for col in table.primary_key])
+                .order_by(sa.func.random())
+                .limit(limit)
+            )
+            pks = [tuple(row) for row in connection.execute(stmt)]
+            if len(pks) == limit:
+                return pks
+    return _sample_pks_by_order(connection, table, limit)
+
+
+def _sample_pks_by_reservoir(
+    connection: sa.Connection,
+    table: sa.Table,
+    limit: int,
+    batch_size: int = 10000,
+) -> T.List[tuple]:
+    """
+    Reservoir sampling (algorithm R) over a keyset paginated stream of the
+    primary key. One pass on the primary key index, ``limit`` keys in memory.
+    """
+    pk_cols = list(table.primary_key)
+    reservoir = list()
+    n_seen = 0
+    last = None
+    while True:
+        stmt = sa.select(*pk_cols)
+        if last is not None:
+            stmt = stmt.where(_keyset_after(connection.dialect, pk_cols, last))
+        stmt = stmt.order_by(*pk_cols).limit(batch_size)
+        rows = connection.execute(stmt).all()
+        for row in rows:
+            n_seen += 1
+            if len(reservoir) < limit:
+                reservoir.append(tuple(row))
+            else:
+                ind = random.randrange(n_seen)
+                if ind < limit:
+                    reservoir[ind] = tuple(row)
+        if len(rows) < batch_size:
+            break
+        last = tuple(rows[-1])
+    random.shuffle(reservoir)
+    return reservoir
+
+
+def _sample_pks(
+    connection: sa.Connection,
+    table: sa.Table,
+    limit: T.Optional[int] = None,
+    perc: T.Optional[int] = None,
+    strategy: T.Optional[str] = None,
+) -> T.List[tuple]:
+    """
+    Return the primary key values of the randomly selected rows, in random
+    order. ``perc`` is converted to a row count with the estimated row count,
+    except for the ``TABLESAMPLE`` strategies.
+    """
+    if strategy is None:
+        strategy = _choose_sampling_strategy(connection, table, perc)
+    _ensure_sampling_strategy(table, strategy)
+    if perc is not None:
+        if strategy in ("tablesample_system", "tablesample_bernoulli"):
+            selectable = _tablesample(table, strategy, perc)
+            stmt = sa.select(*[selectable.c[col.name] for col in table.primary_key])
+            pks = [tuple(row) for row in connection.execute(stmt)]
+            random.shuffle(pks)
+            return pks
+        limit = _perc_to_limit(connection, table, perc)
+
+    if strategy == "pk_range":
+        return _sample_pks_by_range(connection, table, limit)
+    elif strategy == "reservoir":
+        return _sample_pks_by_reservoir(connection, table, limit)
+    elif strategy in ("tablesample_system", "tablesample_bernoulli"):
+        return _sample_pks_by_tablesample(connection, table, limit, strategy)
+    else:
+        return _sample_pks_by_order(connection, table, limit)
+
+
 def select_random(
     engine: sa.Engine,
     table: sa.Table = None,
     columns: T.List[sa.Column] = None,
     limit: int = None,
     perc: int = None,
+    strategy: T.Optional[str] = None,
 ) -> sa.Result:
     """
     Randomly select some rows from table.
 
-    :param perc: int from 1 ~ 99. (means 1% ~ 99%)
+    :param perc: int from 1 ~ 99. (means 1% ~ 99%). Except for the
+        ``TABLESAMPLE`` strategies, it is converted to a number of rows with the
+        estimated row count from the planner statistics, so it is approximate.
+    :param strategy: how to pick the rows, by default the strategy that fits
+        the dialect and the table is used.
+
+        - ``"order_by_random"``: ``ORDER BY random() LIMIT n``, sort the
+          whole table, works everywhere.
+        - ``"pk_range"``: draw random integers in ``[min(pk), max(pk)]`` and
+          retry the misses, for single integer primary key.
+        - ``"tablesample_system"``: ``TABLESAMPLE SYSTEM``, sample whole
+          pages, PostgreSQL only.
+        - ``"tablesample_bernoulli"``: ``TABLESAMPLE BERNOULLI``, sample
+          each row, PostgreSQL only.
+        - ``"reservoir"``: reservoir sampling over a keyset paginated stream
+          of the primary key, one pass over the index, for SQLite.
+
+    Except for ``TABLESAMPLE`` with ``perc``, the rows are finally fetched
+    with ``SELECT ... WHERE pk IN (...)``.
 
     Example::
 
@@ -182,38 +1000,137 @@ def select_random(
         # randomly select 5% rows from users table
         for row in sam.selecting.select_random(engine, t_users, perc=5):
             ...
+
+    **中文文档**
+
+    随机选择一些行. 默认根据数据库类型和表结构自动选择采样策略: 单个整数主键时在
+    ``[min(pk), max(pk)]`` 范围内随机抽取主键并对未命中的重试; PostgreSQL 使用
+    ``TABLESAMPLE``; SQLite 对主键做 keyset 分页流式的蓄水池抽样. 这样在大表上
+    无需 ``ORDER BY random()`` 对全表排序.
     """
     ensure_exact_one_arg_is_not_none(limit, perc)
     ensure_exact_one_arg_is_not_none(table, columns)
+    if perc is not None:
+        if perc >= 100 or perc <= 0:
+            raise ValueError
+    if table is None:
+        table = columns[0].table
+    else:
+        columns = list(table.columns)
 
-    if table is not None:
-        if limit is not None:
-            stmt = sa.select(table).order_by(sa.func.random()).limit(limit)
-        else:
-            if perc >= 100 or perc <= 0:
-                raise ValueError
-
-            selectable = table.tablesample(
-                sa.func.bernoulli(perc), name="alias", seed=sa.func.random()
+    with engine.connect() as connection:
+        if strategy is None:
+            strategy = _choose_sampling_strategy(connection, table, perc)
+        _ensure_sampling_strategy(table, strategy)
+        if (perc is not None) and (
+            strategy in ("tablesample_system", "tablesample_bernoulli")
+        ):
+            selectable = _tablesample(table, strategy, perc)
+            stmt = sa.select(*[selectable.c[column.name] for column in columns])
+        elif strategy == "order_by_random":
+            if limit is None:
+                limit = _perc_to_limit(connection, table, perc)
+            stmt = (
+                sa.select(*columns)
+                .order_by(_random_func(connection.dialect))
+                .limit(limit)
             )
-            args = [getattr(selectable.c, column.name) for column in table.columns]
-            stmt = sa.select(*args)
-    elif columns is not None:
-        if limit is not None:
-            stmt = sa.select(*columns).order_by(sa.func.random()).limit(limit)
         else:
-            if perc >= 100 or perc <= 0:
-                raise ValueError
-            selectable = columns[0].table.tablesample(
-                sa.func.bernoulli(perc), name="alias", seed=sa.func.random()
+            pks = _sample_pks(connection, table, limit, perc, strategy)
+            stmt = (
+                sa.select(*columns)
+                .where(pk_in_clause(list(table.primary_key), pks))
+                .order_by(_random_func(connection.dialect))
             )
-            args = [getattr(selectable.c, column.name) for column in columns]
-            stmt = sa.select(*args)
-    else:  # pragma: no cover, for readability only
-        raise NotImplementedError
+        return _buffer(connection.execute(stmt))
 
-    with engine.connect() as connection:
-        return connection.execute(stmt)
+
+_row_value_dialects = {"postgresql", "sqlite", "mysql", "mariadb"}
+
+
+def _keyset_after(
+    dialect: sa.Dialect,
+    pk_cols: T.List[sa.Column],
+    last: tuple,
+) -> sa.ColumnElement:
+    """
+    The ``WHERE`` clause of the next page, rows whose primary key is after
+    ``last`` in the primary key order.
+
+    Row value comparison ``(a, b) > (:a, :b)`` is used if the dialect supports
+    it, otherwise the expanded form ``a > :a OR (a = :a AND b > :b)``.
+    """
+    if len(pk_cols) == 1:
+        return pk_cols[0] > last[0]
+    if dialect.name in _row_value_dialects:
+        return sa.tuple_(*pk_cols) > sa.tuple_(*[sa.literal(v) for v in last])
+    clauses = list()
+    for i, col in enumerate(pk_cols):
+        clauses.append(
+            sa.and_(
+                *[pk_cols[j] == last[j] for j in range(i)],
+                col > last[i],
+            )
+        )
+    return sa.or_(*clauses)
+
+
+def iter_rows(
+    engine: sa.Engine,
+    table: sa.Table,
+    batch_size: int = 1000,
+    where: T.Optional[sa.ColumnElement] = None,
+    as_batch: bool = False,
+) -> T.Iterable[T.Union[sa.Row, T.List[sa.Row]]]:
+    """
+    Stream all rows from a table with keyset pagination on the primary key::
+
+        SELECT * FROM table WHERE pk > :last ORDER BY pk LIMIT :batch_size
+
+    Unlike ``OFFSET`` pagination, every page is one index range scan, so the
+    latency of each page is stable no matter how deep it is. Only one page is
+    in memory, and the connection is returned to the pool between pages.
+
+    :param batch_size: number of rows in each page.
+    :param where: optional extra filter.
+    :param as_batch: if True, yield list of rows per page instead of row.
+
+    Example::
+
+        for row in sam.selecting.iter_rows(engine, t_users, batch_size=5000):
+            ...
+
+    **中文文档**
+
+    基于主键的 keyset 分页, 流式读取整个表. 与 OFFSET 分页不同, 每一页都是一次索引
+    范围扫描, 无论翻到第几页延迟都是稳定的. 内存中最多只有一页数据, 并且在两页之间
+    不会占用数据库连接. 支持复合主键.
+    """
+    pk_cols = list(table.primary_key)
+    if len(pk_cols) == 0:
+        raise ValueError(f"table {table.name!r} has no primary key")
+    pk_names = [col.name for col in pk_cols]
+
+    last = None
+    while True:
+        stmt = sa.select(table)
+        if where is not None:
+            stmt = stmt.where(where)
+        if last is not None:
+            stmt = stmt.where(_keyset_after(engine.dialect, pk_cols, last))
+        stmt = stmt.order_by(*pk_cols).limit(batch_size)
+        with engine.connect() as connection:
+            rows = connection.execute(stmt).all()
+        if len(rows) == 0:
+            break
+        if as_batch:
+            yield rows
+        else:
+            yield from rows
+        if len(rows) < batch_size:
+            break
+        mapping = rows[-1]._mapping
+        last = tuple([mapping[name] for name in pk_names])
 
 
 def yield_tuple(result: sa.Result) -> T.Iterable[tuple]:
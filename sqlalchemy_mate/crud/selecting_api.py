@@ -2,11 +2,15 @@
 
 from .selecting import count_row
 from .selecting import by_pk
+from .selecting import by_pks
 from .selecting import select_all
 from .selecting import select_single_column
 from .selecting import select_many_column
+from .selecting import select_columnar
 from .selecting import select_single_distinct
 from .selecting import select_many_distinct
 from .selecting import select_random
+from .selecting import SelectionHandle
+from .selecting import iter_rows
 from .selecting import yield_tuple
 from .selecting import yield_dict
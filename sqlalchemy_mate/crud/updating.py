@@ -6,15 +6,400 @@ This module provide utility functions for update operation.
 
 # from typing import Union, List, Tuple, Dict, Any
 import typing as T
+import uuid
 from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 
 import sqlalchemy as sa
+from sqlalchemy.orm.exc import StaleDataError
 
 # from sqlalchemy import and_
 # from sqlalchemy import Table
 # from sqlalchemy.engine import Engine
 
-from ..utils import ensure_list
+from ..utils import (
+    ensure_list,
+    grouper_list,
+    get_pk_value,
+    get_max_rows_per_statement,
+    select_existing_pks,
+    select_existing_rows,
+    select_rows_by_pks,
+    BatchCommitter,
+)
+from .inserting import T_REJECTED_SINK, report_rejected
+
+
+def _row_by_row_update(
+    connection: sa.Connection,
+    table: sa.Table,
+    data: T.List[T.Dict[str, T.Any]],
+) -> T.Tuple[int, T.List[T.Dict[str, T.Any]]]:
+    """
+    The "one UPDATE and one COMMIT per row" implementation of
+    :func:`update_all`.
+
+    :return: number of rows updated, the rows that matched nothing.
+    """
+    update_counter = 0
+    upd = table.update()
+
+    # Find all primary key columns
+    pk_cols = OrderedDict()
+    for column in table._columns:
+        if column.primary_key:
+            pk_cols[column.name] = column
+
+    data_to_insert = list()
+
+    # Multiple primary key column
+    if len(pk_cols) >= 2:
+        for row in data:
+            result = connection.execute(
+                upd.where(
+                    sa.and_(*[col == row[name] for name, col in pk_cols.items()])
+                ).values(**row)
+            )
+            connection.commit()
+            if result.rowcount == 0:
+                data_to_insert.append(row)
+            else:
+                update_counter += 1
+    # Single primary key column
+    elif len(pk_cols) == 1:
+        for row in data:
+            result = connection.execute(
+                upd.where(
+                    [col == row[name] for name, col in pk_cols.items()][0]
+                ).values(**row)
+            )
+            connection.commit()
+            if result.rowcount == 0:
+                data_to_insert.append(row)
+            else:
+                update_counter += 1
+    else:  # pragma: no cover
+        data_to_insert = data
+
+    return update_counter, data_to_insert
+
+
+def _executemany_update(
+    connection: sa.Connection,
+    table: sa.Table,
+    data: T.List[T.Dict[str, T.Any]],
+) -> T.Tuple[int, T.List[T.Dict[str, T.Any]]]:
+    """
+    The executemany implementation of :func:`update_all`. Rows are grouped by
+    their set of keys, each group is one
+    ``UPDATE ... WHERE pk = :b_pk`` statement executed with many parameter sets,
+    so the statement is compiled once and cached. The rows that match nothing
+    are found with a keyed SELECT.
+
+    :return: number of rows updated, the rows that matched nothing.
+    """
+    pk_cols = list(table.primary_key)
+    pk_names = [col.name for col in pk_cols]
+    if len(pk_cols) == 0:  # pragma: no cover
+        return 0, data
+
+    update_counter = 0
+    data_to_insert = list()
+    for keys, rows in _group_by_keys(pk_names, data):
+        if not all(name in keys for name in pk_names):
+            data_to_insert.extend(rows)
+            continue
+        existing = select_existing_pks(
+            connection,
+            table,
+            [get_pk_value(pk_names, row) for row in rows],
+        )
+        rows_to_update = list()
+        for row in rows:
+            if get_pk_value(pk_names, row) in existing:
+                rows_to_update.append(row)
+            else:
+                data_to_insert.append(row)
+        update_names = [name for name in keys if name not in pk_names]
+        if len(rows_to_update) and len(update_names):
+            stmt = table.update().where(
+                sa.and_(*[col == sa.bindparam(f"b_{col.name}") for col in pk_cols])
+            )
+            params = list()
+            for row in rows_to_update:
+                param = {name: row[name] for name in update_names}
+                for name in pk_names:
+                    param[f"b_{name}"] = row[name]
+                params.append(param)
+            connection.execute(stmt, params)
+        update_counter += len(rows_to_update)
+    return update_counter, data_to_insert
+
+
+def _staging_update(
+    connection: sa.Connection,
+    table: sa.Table,
+    data: T.List[T.Dict[str, T.Any]],
+    upsert: bool,
+) -> T.Tuple[int, int]:
+    """
+    The temporary table implementation of :func:`update_all`. For each set of
+    keys, bulk load the rows into a temporary staging table, then apply them
+    with set based statements::
+
+        SELECT count(*) FROM staging JOIN table ON pk
+        UPDATE table SET ... FROM staging WHERE pk = staging.pk
+        INSERT INTO table SELECT ... FROM staging WHERE NOT EXISTS (...)
+
+    :return: number of rows updated, number of rows inserted.
+    """
+    pk_cols = list(table.primary_key)
+    pk_names = [col.name for col in pk_cols]
+    if len(pk_cols) == 0:  # pragma: no cover
+        if upsert and len(data):
+            connection.execute(table.insert(), data)
+            return 0, len(data)
+        return 0, 0
+
+    update_counter = 0
+    insert_counter = 0
+    for keys, rows in _group_by_keys(pk_names, data):
+        if not all(name in keys for name in pk_names):
+            if upsert:
+                connection.execute(table.insert(), rows)
+                insert_counter += len(rows)
+            continue
+        # a row can only be applied once in a set based statement, the last one wins
+        rows = list(
+            OrderedDict([(get_pk_value(pk_names, row), row) for row in rows]).values()
+        )
+        columns = [col for col in table.columns if col.name in keys]
+        staging = sa.Table(
+            f"_staging_{table.name}_{uuid.uuid4().hex[:8]}",
+            sa.MetaData(),
+            *[sa.Column(col.name, col.type) for col in columns],
+            prefixes=["TEMPORARY"],
+        )
+        staging.create(connection)
+        try:
+            connection.execute(staging.insert(), rows)
+            match = sa.and_(*[col == staging.c[col.name] for col in pk_cols])
+            n_updated = connection.execute(
+                sa.select(sa.func.count()).select_from(staging).join(table, match)
+            ).scalar()
+            update_names = [col.name for col in columns if col.name not in pk_names]
+            if n_updated and len(update_names):
+                connection.execute(
+                    table.update()
+                    .values({name: staging.c[name] for name in update_names})
+                    .where(match)
+                )
+            if upsert and (n_updated < len(rows)):
+                connection.execute(
+                    table.insert().from_select(
+                        [col.name for col in columns],
+                        sa.select(*staging.columns).where(~sa.exists().where(match)),
+                    )
+                )
+                insert_counter += len(rows) - n_updated
+            update_counter += n_updated
+        finally:
+            staging.drop(connection)
+    return update_counter, insert_counter
+
+
+def _drop_unchanged_rows(
+    connection: sa.Connection,
+    table: sa.Table,
+    data: T.List[T.Dict[str, T.Any]],
+    hash_column: T.Optional[str] = None,
+) -> T.Tuple[T.List[T.Dict[str, T.Any]], int]:
+    """
+    Fetch the existing rows with one keyed SELECT per chunk, drop the rows
+    that are identical to what is already stored. Rows are compared column
+    by column, or only by ``hash_column`` if it is given and present in the row.
+
+    :return: the rows to write, number of rows unchanged.
+    """
+    pk_names = [col.name for col in table.primary_key]
+    if len(pk_names) == 0:  # pragma: no cover
+        return data, 0
+    existing = select_existing_rows(
+        connection,
+        table,
+        [get_pk_value(pk_names, row) for row in data],
+        columns=None if hash_column is None else [hash_column],
+    )
+    rows_to_write = list()
+    unchanged_counter = 0
+    for row in data:
+        stored = existing.get(get_pk_value(pk_names, row))
+        if stored is None:
+            rows_to_write.append(row)
+        elif (hash_column is not None) and (hash_column in row):
+            if row[hash_column] == stored[hash_column]:
+                unchanged_counter += 1
+            else:
+                rows_to_write.append(row)
+        elif all([stored.get(key) == value for key, value in row.items()]):
+            unchanged_counter += 1
+        else:
+            rows_to_write.append(row)
+    return rows_to_write, unchanged_counter
+
+
+def _compare_and_swap(
+    committer: BatchCommitter,
+    stmt: sa.Update,
+    params: T.List[T.Dict[str, T.Any]],
+    rows: T.List[T.Dict[str, T.Any]],
+    conflicts: T.Optional[T_REJECTED_SINK],
+) -> int:
+    """
+    Run the versioned UPDATE with executemany in a savepoint. If fewer rows
+    are matched than sent, roll it back and bisect to find the rows whose
+    version has been changed by another writer.
+
+    :return: number of rows updated.
+    """
+    connection = committer.conn
+    try:
+        with committer.attempt():
+            result = connection.execute(stmt, params)
+            if result.rowcount != len(params):
+                raise StaleDataError(
+                    f"UPDATE statement on table {stmt.table.name!r} expected to "
+                    f"update {len(params)} row(s); {result.rowcount} were matched."
+                )
+        return len(params)
+    except StaleDataError as e:
+        if len(params) == 1:
+            report_rejected(conflicts, rows[0], e)
+            return 0
+        middle = len(params) // 2
+        return _compare_and_swap(
+            committer, stmt, params[:middle], rows[:middle], conflicts
+        ) + _compare_and_swap(
+            committer, stmt, params[middle:], rows[middle:], conflicts
+        )
+
+
+def _next_timestamp_version(
+    version_col: sa.Column,
+    old: T.Optional[datetime],
+) -> datetime:
+    """
+    The new value of a DateTime version column, the client side current time
+    with microseconds, at least one microsecond after the old value. It is
+    bound through the column type, so the value read back compares equal.
+    """
+    now = datetime.now(timezone.utc)
+    if not version_col.type.timezone:
+        now = now.replace(tzinfo=None)
+    try:
+        if (old is not None) and (now <= old):
+            now = old + timedelta(microseconds=1)
+    except TypeError:  # pragma: no cover, naive vs aware
+        pass
+    return now
+
+
+def _versioned_update(
+    connection: sa.Connection,
+    table: sa.Table,
+    data: T.List[T.Dict[str, T.Any]],
+    version_column: str,
+    conflicts: T.Optional[T_REJECTED_SINK],
+) -> T.Tuple[int, T.List[T.Dict[str, T.Any]]]:
+    """
+    The optimistic concurrency implementation of :func:`update_all`. Each
+    group of rows with the same set of keys is one
+    ``UPDATE ... SET version = version + 1 WHERE pk = :b_pk AND version = :b_version``
+    executemany. The rows that match nothing are found with a keyed SELECT.
+    The version is compared with ``IS NOT DISTINCT FROM``, so a NULL version
+    is matched by a NULL ``:b_version``, and a NULL integer version becomes 1.
+    A DateTime version is set to the client side time, see
+    :func:`_next_timestamp_version`.
+
+    :return: number of rows updated, the rows that matched nothing.
+    """
+    pk_cols = list(table.primary_key)
+    pk_names = [col.name for col in pk_cols]
+    version_col = table.c[version_column]
+    if isinstance(version_col.type, sa.Integer):
+        new_version = sa.func.coalesce(version_col, 0) + 1
+    elif isinstance(version_col.type, sa.DateTime):
+        new_version = sa.bindparam(f"n_{version_column}", type_=version_col.type)
+    else:
+        raise ValueError(
+            f"version column {version_column!r} has to be Integer or DateTime, "
+            f"got {version_col.type!r}"
+        )
+    committer = BatchCommitter(connection, use_savepoint=True, errors=(StaleDataError,))
+    if connection.dialect.supports_sane_multi_rowcount:
+        size = len(data) or 1
+    else:  # pragma: no cover
+        size = 1  # the total rowcount of executemany is unknown
+
+    update_counter = 0
+    data_to_insert = list()
+    for keys, rows in _group_by_keys(pk_names, data):
+        if not all(name in keys for name in pk_names):
+            data_to_insert.extend(rows)
+            continue
+        if version_column not in keys:
+            raise ValueError(
+                f"row has no {version_column!r} value to compare with: {rows[0]!r}"
+            )
+        existing = select_existing_pks(
+            connection,
+            table,
+            [get_pk_value(pk_names, row) for row in rows],
+        )
+        rows_to_update = list()
+        for row in rows:
+            if get_pk_value(pk_names, row) in existing:
+                rows_to_update.append(row)
+            else:
+                data_to_insert.append(row)
+        if len(rows_to_update) == 0:
+            continue
+        update_names = [
+            name for name in keys if name not in pk_names and name != version_column
+        ]
+        stmt = (
+            table.update()
+            .where(
+                *[col == sa.bindparam(f"b_{col.name}") for col in pk_cols],
+                version_col.is_not_distinct_from(
+                    sa.bindparam(f"b_{version_column}", type_=version_col.type)
+                ),
+            )
+            .values({version_column: new_version})
+        )
+        params = list()
+        for row in rows_to_update:
+            param = {name: row[name] for name in update_names}
+            for name in pk_names + [version_column]:
+                param[f"b_{name}"] = row[name]
+            if isinstance(version_col.type, sa.DateTime):
+                param[f"n_{version_column}"] = _next_timestamp_version(
+                    version_col, row[version_column]
+                )
+            params.append(param)
+        for start in range(0, len(params), size):
+            update_counter += _compare_and_swap(
+                committer,
+                stmt,
+                params[start : start + size],
+                rows_to_update[start : start + size],
+                conflicts,
+            )
+    committer.finish()
+    return update_counter, data_to_insert
+
+
+_update_strategies = {"executemany", "row_by_row", "staging"}
 
 
 def update_all(
@@ -22,74 +407,384 @@ def update_all(
     table: sa.Table,
     data: T.Union[T.Dict[str, T.Any], T.List[T.Dict[str, T.Any]]],
     upsert=False,
-) -> T.Tuple[int, int]:
+    strategy: str = "executemany",
+    skip_unchanged: bool = False,
+    hash_column: T.Optional[str] = None,
+    version_column: T.Optional[str] = None,
+    conflicts: T.Optional[T_REJECTED_SINK] = None,
+) -> T.Union[T.Tuple[int, int], T.Tuple[int, int, int]]:
     """
     Update data by its primary_key column values. By default upsert is False.
-    """
-    with engine.connect() as connection:
-        update_counter = 0
-        insert_counter = 0
 
-        data = ensure_list(data)
+    :param strategy: how to send the UPDATE statements.
 
-        ins = table.insert()
-        upd = table.update()
+        - ``"executemany"``: group rows by their set of keys, run one
+          ``UPDATE ... WHERE pk = :b_pk`` statement with many parameter sets
+          per group, commit once at the end. If the same primary key appears
+          more than once, the rows are applied in the input order.
+        - ``"row_by_row"``: one UPDATE and one COMMIT per row.
+        - ``"staging"``: bulk load the rows into a temporary table, then apply
+          them with one ``UPDATE ... FROM staging`` and one
+          ``INSERT ... SELECT ... WHERE NOT EXISTS`` per set of keys, commit
+          once at the end. Best for hundreds of thousands of rows. If the same
+          primary key appears more than once, the last one wins.
 
-        # Find all primary key columns
-        pk_cols = OrderedDict()
-        for column in table._columns:
-            if column.primary_key:
-                pk_cols[column.name] = column
+    :param skip_unchanged: if True, fetch the existing rows with one keyed
+        SELECT per chunk, and only write the rows that differ from what is
+        already stored. It avoids the UPDATE, the WAL and the triggers of the
+        no-op writes.
+    :param hash_column: if given, and the row has this key, compare the rows
+        by this column only (for example a content hash maintained by the
+        application) instead of column by column.
+    :param version_column: if given, use optimistic concurrency control. Each
+        row carries the version value it was read with, the row is only updated
+        if the stored version is still the same, and the version is moved
+        forward in the same statement: ``+ 1`` for Integer column, the client
+        side current time with microseconds (at least one microsecond after the
+        old value) for DateTime column, other types are not supported. The
+        DateTime column has to keep microseconds (for example
+        ``DATETIME(6)`` in MySQL), otherwise two updates in the same second
+        can't be told apart. It runs as
+        ``UPDATE ... WHERE pk = :b_pk AND version = :b_version`` executemany,
+        ``strategy`` is ignored.
+    :param conflicts: where to send the rows that lost the race, a list or a
+        callable, see :func:`sqlalchemy_mate.crud.inserting.smart_insert`.
+        The ``error_class`` is :class:`sqlalchemy.orm.exc.StaleDataError`.
 
-        data_to_insert = list()
+    :return: number of rows updated, number of rows inserted. If
+        ``skip_unchanged`` is True, return number of rows updated, inserted
+        and unchanged.
 
-        # Multiple primary key column
-        if len(pk_cols) >= 2:
-            for row in data:
-                result = connection.execute(
-                    upd.where(
-                        sa.and_(*[col == row[name] for name, col in pk_cols.items()])
-                    ).values(**row)
-                )
-                connection.commit()
-                if result.rowcount == 0:
-                    data_to_insert.append(row)
-                else:
-                    update_counter += 1
-        # Single primary key column
-        elif len(pk_cols) == 1:
-            for row in data:
-                result = connection.execute(
-                    upd.where(
-                        [col == row[name] for name, col in pk_cols.items()][0]
-                    ).values(**row)
-                )
-                connection.commit()
-                if result.rowcount == 0:
-                    data_to_insert.append(row)
-                else:
-                    update_counter += 1
-        else:  # pragma: no cover
-            data_to_insert = data
+    **中文文档**
+
+    根据主键批量更新数据. 默认使用 ``strategy="executemany"``, 将拥有相同字段的行分为
+    一组, 每组只编译一次 ``UPDATE ... WHERE pk = :b_pk`` 语句并用 executemany 执行,
+    最后只 commit 一次. 不存在的行由一次基于主键的 SELECT 找出. 如果 ``upsert=True``,
+    则将这些行批量插入.
+
+    对于几十万行以上的数据, 可以使用 ``strategy="staging"``: 先将数据批量写入一个
+    临时表, 然后用一条 ``UPDATE ... FROM staging`` 和一条
+    ``INSERT ... SELECT ... WHERE NOT EXISTS`` 完成全部更新和插入, 将 N 条语句
+    变成几条基于集合的语句.
+
+    如果使用 ``skip_unchanged=True``, 则先用基于主键的 SELECT 取出已有的行, 在内存中
+    逐列比较 (或者只比较 ``hash_column``), 只写入有变化的行. 此时返回值为
+    (更新的行数, 插入的行数, 未变化的行数).
+
+    如果使用 ``version_column``, 则使用乐观锁: 只有当数据库中的版本号仍然等于该行
+    携带的版本号时才会更新, 同时将版本号加一 (或者更新为客户端的当前时间, 精确到微秒). 所有更新仍然是
+    一个 executemany, 如果匹配到的行数少于发送的行数, 则回滚到 savepoint 并用二分法
+    找出冲突的行, 发送到 ``conflicts``.
+    """
+    if strategy not in _update_strategies:
+        raise ValueError(f"invalid strategy {strategy!r}")
+
+    with engine.connect() as connection:
+        data = ensure_list(data)
+        if skip_unchanged:
+            data, unchanged_counter = _drop_unchanged_rows(
+                connection, table, data, hash_column=hash_column
+            )
+        if version_column is not None:
+            update_counter, data_to_insert = _versioned_update(
+                connection, table, data, version_column, conflicts
+            )
+        elif strategy == "staging":
+            update_counter, insert_counter = _staging_update(
+                connection, table, data, upsert
+            )
+        elif strategy == "executemany":
+            update_counter, data_to_insert = _executemany_update(
+                connection, table, data
+            )
+        else:
+            update_counter, data_to_insert = _row_by_row_update(connection, table, data)
 
         # Insert rest of data
-        if upsert:
-            if len(data_to_insert):
-                connection.execute(ins, data_to_insert)
-                connection.commit()
-                insert_counter += len(data_to_insert)
+        if (strategy != "staging") or (version_column is not None):
+            insert_counter = 0
+            if upsert:
+                if len(data_to_insert):
+                    connection.execute(table.insert(), data_to_insert)
+                    insert_counter += len(data_to_insert)
+        connection.commit()
 
+        if skip_unchanged:
+            return update_counter, insert_counter, unchanged_counter
         return update_counter, insert_counter
 
 
+_merge_policies = {"keep_existing", "overwrite", "coalesce", "max", "min", "sum"}
+
+
+def _merge_expression(
+    dialect: sa.Dialect,
+    existing: sa.Column,
+    incoming: sa.ColumnElement,
+    policy: str,
+) -> T.Optional[sa.ColumnElement]:
+    """
+    The ``SET`` expression of one column in the upsert statement. Return None
+    if the column should not be updated.
+    """
+    if policy == "overwrite":
+        return incoming
+    elif policy == "keep_existing":
+        return None
+    elif policy == "coalesce":
+        return sa.func.coalesce(incoming, existing)
+    elif policy == "sum":
+        return sa.func.coalesce(existing, 0) + sa.func.coalesce(incoming, 0)
+    elif policy in ("max", "min"):
+        # SQLite uses the multi arguments max() / min(), NULL is ignored on all
+        # dialects by coalescing both sides
+        if dialect.name == "sqlite":
+            func = getattr(sa.func, policy)
+        else:
+            func = sa.func.greatest if policy == "max" else sa.func.least
+        return func(
+            sa.func.coalesce(existing, incoming),
+            sa.func.coalesce(incoming, existing),
+        )
+    else:
+        raise ValueError(f"invalid merge policy {policy!r}")
+
+
+def get_upsert_insert(
+    table: sa.Table,
+    dialect: sa.Dialect,
+    rows: T.List[T.Dict[str, T.Any]],
+    merge_policy: T.Optional[T.Dict[str, str]] = None,
+) -> T.Optional[sa.Insert]:
+    """
+    Return a multi rows INSERT statement that updates the existing rows
+    (matched by primary key) instead of failing. All rows has to have the same
+    set of keys, the non primary key columns in the keys are updated.
+    Return None if the dialect doesn't support this feature.
+
+    - PostgreSQL / SQLite: ``INSERT ... ON CONFLICT (pk) DO UPDATE``
+    - MySQL: ``INSERT ... ON DUPLICATE KEY UPDATE``
+
+    :param merge_policy: column name to conflict policy mapping, how to merge
+        the incoming value with the existing value, default is ``"overwrite"``.
+
+        - ``"overwrite"``: use the incoming value.
+        - ``"keep_existing"``: don't update this column.
+        - ``"coalesce"``: use the incoming value only if it is not NULL.
+        - ``"max"`` / ``"min"``: use the larger / smaller one, NULL is ignored.
+        - ``"sum"``: add the incoming value to the existing value, NULL is 0.
+
+    **中文文档**
+
+    根据数据库的方言, 返回一个遇到主键冲突时自动更新已有行的多行 INSERT 语句.
+    如果该数据库不支持这一语法, 则返回 None.
+
+    ``merge_policy`` 可以为每一列指定新旧值的合并方式, 例如计数器用 ``"sum"``,
+    最后一次出现的时间用 ``"max"``, 这样只需要一条语句就能完成合并, 而无需先读后写.
+    """
+    merge_policy = merge_policy or dict()
+    for policy in merge_policy.values():
+        if policy not in _merge_policies:
+            raise ValueError(f"invalid merge policy {policy!r}")
+    pk_cols = list(table.primary_key)
+    pk_names = [col.name for col in pk_cols]
+    update_names = [name for name in rows[0] if name not in pk_names]
+
+    if dialect.name in ("postgresql", "sqlite"):
+        if dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+
+        stmt = insert(table).values(rows)
+        incoming = stmt.excluded
+    elif dialect.name in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert
+
+        stmt = insert(table).values(rows)
+        incoming = stmt.inserted
+    else:
+        return None
+
+    set_ = dict()
+    for name in update_names:
+        expr = _merge_expression(
+            dialect,
+            table.c[name],
+            incoming[name],
+            merge_policy.get(name, "overwrite"),
+        )
+        if expr is not None:
+            set_[name] = expr
+
+    if dialect.name in ("postgresql", "sqlite"):
+        if set_:
+            return stmt.on_conflict_do_update(index_elements=pk_cols, set_=set_)
+        else:
+            return stmt.on_conflict_do_nothing(index_elements=pk_cols)
+    else:
+        if not set_:  # nothing to update, set primary key to itself
+            set_ = {name: incoming[name] for name in pk_names}
+        return stmt.on_duplicate_key_update(set_)
+
+
+def _group_by_keys(
+    pk_names: T.List[str],
+    data: T.Iterable[T.Dict[str, T.Any]],
+) -> T.List[T.Tuple[T.Tuple[str, ...], T.List[T.Dict[str, T.Any]]]]:
+    """
+    Group rows by their set of keys, so that each group can be sent in one
+    multi rows statement. The groups are sent one after another, if a primary
+    key shows up again with a different set of keys, a new round of groups is
+    started, so the rows of the same primary key are still applied in the
+    input order.
+
+    :return: list of (keys, rows) pairs, in the order they should be sent.
+    """
+    groups = list()
+    round_groups = OrderedDict()
+    round_keys = dict()  # primary key value -> set of keys in this round
+    for row in data:
+        keys = tuple(sorted(row))
+        pk = get_pk_value(pk_names, row)
+        if None not in pk:
+            if round_keys.setdefault(pk, keys) != keys:
+                groups.extend(round_groups.items())
+                round_groups = OrderedDict()
+                round_keys = {pk: keys}
+        round_groups.setdefault(keys, []).append(row)
+    groups.extend(round_groups.items())
+    return groups
+
+
+def _split_duplicates(
+    pk_names: T.List[str],
+    rows: T.List[T.Dict[str, T.Any]],
+) -> T.List[T.List[T.Dict[str, T.Any]]]:
+    """
+    A row can only be affected once in one upsert statement. Split the rows
+    into rounds, each round has unique primary key values, and the n-th
+    occurrence of a primary key goes to the n-th round.
+    """
+    rounds = list()
+    seen = dict()
+    for row in rows:
+        pk = get_pk_value(pk_names, row)
+        nth = seen.get(pk, 0)
+        seen[pk] = nth + 1
+        if nth == len(rounds):
+            rounds.append(list())
+        rounds[nth].append(row)
+    return rounds
+
+
+def _get_upsert_chunks(
+    dialect: sa.Dialect,
+    table: sa.Table,
+    data: T.List[T.Dict[str, T.Any]],
+    batch_size: T.Optional[int] = None,
+) -> T.List[T.List[T.Dict[str, T.Any]]]:
+    """
+    Split the rows into chunks for the multi rows upsert statement. Rows in
+    one chunk have the same set of keys and unique primary key values, and
+    the chunk is sized to the bound parameter limit.
+    """
+    pk_names = [col.name for col in table.primary_key]
+    chunks = list()
+    for keys, rows in _group_by_keys(pk_names, data):
+        size = batch_size or get_max_rows_per_statement(dialect, len(keys))
+        if all(name in keys for name in pk_names):
+            for round_rows in _split_duplicates(pk_names, rows):
+                chunks.extend(grouper_list(round_rows, size))
+        else:
+            chunks.extend(grouper_list(rows, size))
+    return chunks
+
+
+def _native_upsert(
+    connection: sa.Connection,
+    table: sa.Table,
+    data: T.List[T.Dict[str, T.Any]],
+    batch_size: T.Optional[int] = None,
+    merge_policy: T.Optional[T.Dict[str, str]] = None,
+) -> T.Tuple[int, int]:
+    """
+    The ``INSERT ... ON CONFLICT DO UPDATE`` implementation of
+    :func:`upsert_all`, one statement and one commit per chunk.
+
+    The inserted rows are counted with ``RETURNING (xmax = 0)`` on PostgreSQL,
+    on other dialects the existing primary keys in the chunk are selected
+    before the upsert.
+    """
+    pk_names = [col.name for col in table.primary_key]
+    update_counter = 0
+    insert_counter = 0
+    for chunk in _get_upsert_chunks(connection.dialect, table, data, batch_size):
+        stmt = get_upsert_insert(
+            table, connection.dialect, chunk, merge_policy=merge_policy
+        )
+        if connection.dialect.name == "postgresql":
+            result = connection.execute(stmt.returning(sa.literal_column("(xmax = 0)")))
+            flags = [row[0] for row in result]
+            n_inserted = sum(flags)
+            # existing rows are not returned by ON CONFLICT DO NOTHING
+            n_updated = len(chunk) - n_inserted
+        else:
+            existing = select_existing_pks(
+                connection,
+                table,
+                [get_pk_value(pk_names, row) for row in chunk],
+            )
+            connection.execute(stmt)
+            n_updated = sum([get_pk_value(pk_names, row) in existing for row in chunk])
+            n_inserted = len(chunk) - n_updated
+        connection.commit()
+        update_counter += n_updated
+        insert_counter += n_inserted
+    return update_counter, insert_counter
+
+
+_upsert_dialects = {"postgresql", "sqlite", "mysql", "mariadb"}
+
+
 def upsert_all(
     engine: sa.Engine,
     table: sa.Table,
     data: T.Union[T.Dict[str, T.Any], T.List[T.Dict[str, T.Any]]],
-) -> T.Tuple[int, int]:
+    batch_size: T.Optional[int] = None,
+    strategy: T.Optional[str] = None,
+    skip_unchanged: bool = False,
+    hash_column: T.Optional[str] = None,
+    version_column: T.Optional[str] = None,
+    conflicts: T.Optional[T_REJECTED_SINK] = None,
+    merge_policy: T.Optional[T.Dict[str, str]] = None,
+) -> T.Union[T.Tuple[int, int], T.Tuple[int, int, int]]:
     """
     Update data by primary key columns. If not able to update, do insert.
 
+    On PostgreSQL / SQLite it uses native ``INSERT ... ON CONFLICT (pk) DO UPDATE``,
+    on MySQL it uses ``INSERT ... ON DUPLICATE KEY UPDATE``, rows are sent in
+    multi rows statements, one commit per statement. Other dialects fall back to
+    :func:`update_all` then a bulk INSERT of the rows that matched nothing.
+
+    :param batch_size: max number of rows in one statement, by default it is
+        sized to the dialect's bound parameter limit.
+    :param strategy: if given, use :func:`update_all` with this strategy
+        instead of the native upsert, for example ``"staging"``.
+    :param skip_unchanged: see :func:`update_all`.
+    :param hash_column: see :func:`update_all`.
+    :param version_column: see :func:`update_all`, it always uses
+        :func:`update_all` instead of the native upsert.
+    :param conflicts: see :func:`update_all`.
+    :param merge_policy: column name to conflict policy mapping, for example
+        ``{"hit_count": "sum", "last_seen": "max"}``, see
+        :func:`get_upsert_insert`. Only available with the native upsert.
+
+    :return: number of rows updated, number of rows inserted. If the same primary
+        key appears more than once in ``data``, the rows are applied in the
+        input order, the later one is sent in a later statement, it is merged
+        with (or overwrites) the earlier one and counted as an update.
+
     Example::
 
         # define data model
@@ -116,5 +811,129 @@ def upsert_all(
 
     批量更新文档. 如果该表格定义了Primary Key, 则用Primary Key约束where语句. 对于
     where语句无法找到的行, 自动进行批量 bulk insert.
+
+    在 PostgreSQL / SQLite 上使用原生的 ``INSERT ... ON CONFLICT (pk) DO UPDATE``,
+    在 MySQL 上使用 ``INSERT ... ON DUPLICATE KEY UPDATE``, 每条语句包含多行数据,
+    每条语句 commit 一次. 其他数据库则退回到 :func:`update_all` 的实现.
+
+    ``merge_policy`` 可以为每一列指定冲突时的合并方式 (``keep_existing``,
+    ``overwrite``, ``coalesce``, ``max``, ``min``, ``sum``), 这样计数器和
+    "最后一次出现的时间" 之类的字段可以在一条语句中完成合并.
     """
-    return update_all(engine=engine, table=table, data=data, upsert=True)
+    is_native = (
+        (strategy is None)
+        and (version_column is None)
+        and (engine.dialect.name in _upsert_dialects)
+        and len(table.primary_key)
+    )
+    if (merge_policy is not None) and (not is_native):
+        raise NotImplementedError(
+            "merge_policy is only supported by the native upsert on "
+            "PostgreSQL, SQLite and MySQL"
+        )
+    if is_native:
+        data = ensure_list(data)
+        with engine.connect() as connection:
+            if skip_unchanged:
+                data, unchanged_counter = _drop_unchanged_rows(
+                    connection, table, data, hash_column=hash_column
+                )
+            update_counter, insert_counter = _native_upsert(
+                connection,
+                table,
+                data,
+                batch_size=batch_size,
+                merge_policy=merge_policy,
+            )
+            if skip_unchanged:
+                return update_counter, insert_counter, unchanged_counter
+            return update_counter, insert_counter
+    else:
+        return update_all(
+            engine=engine,
+            table=table,
+            data=data,
+            upsert=True,
+            strategy=strategy or "executemany",
+            skip_unchanged=skip_unchanged,
+            hash_column=hash_column,
+            version_column=version_column,
+            conflicts=conflicts,
+        )
+
+
+def upsert_returning(
+    engine: sa.Engine,
+    table: sa.Table,
+    data: T.Union[T.Dict[str, T.Any], T.List[T.Dict[str, T.Any]]],
+    batch_size: T.Optional[int] = None,
+    merge_policy: T.Optional[T.Dict[str, str]] = None,
+    as_dict: bool = False,
+) -> T.List[T.Union[sa.Row, T.Dict[str, T.Any]]]:
+    """
+    Same as :func:`upsert_all`, but return the final state of the rows, including
+    the server generated defaults, sequence ids and the merged values.
+
+    Where the dialect supports it (PostgreSQL, SQLite 3.35+, MariaDB), the
+    multi rows upsert statement is sent with ``RETURNING``, so no extra SELECT
+    is needed. Otherwise the rows are fetched with a keyed SELECT after
+    :func:`upsert_all`.
+
+    :param as_dict: if True, return list of dict, otherwise list of
+        :class:`sqlalchemy.Row`.
+
+    :return: one row per distinct primary key, in the order of its first
+        appearance in ``data``, followed by the rows without primary key value
+        (only available with ``RETURNING``).
+
+    **中文文档**
+
+    与 :func:`upsert_all` 相同, 但是返回写入之后每一行的最终状态 (包括数据库生成的
+    默认值, 自增主键以及合并后的值). 在支持 ``RETURNING`` 的数据库上, 无需在 upsert
+    之后再查询一次.
+    """
+    data = ensure_list(data)
+    pk_names = [col.name for col in table.primary_key]
+    dialect = engine.dialect
+    is_native = (
+        (dialect.name in _upsert_dialects)
+        and dialect.insert_returning
+        and len(pk_names)
+    )
+    results = OrderedDict()
+    for row in data:
+        if all(name in row for name in pk_names):
+            results.setdefault(get_pk_value(pk_names, row), None)
+    no_pk_rows = list()
+
+    with engine.connect() as connection:
+        if is_native:
+            for chunk in _get_upsert_chunks(dialect, table, data, batch_size):
+                stmt = get_upsert_insert(
+                    table, dialect, chunk, merge_policy=merge_policy
+                )
+                for row in connection.execute(stmt.returning(*table.columns)):
+                    pk = get_pk_value(pk_names, row._mapping)
+                    if pk in results:
+                        results[pk] = row
+                    else:
+                        no_pk_rows.append(row)
+                connection.commit()
+        else:
+            upsert_all(
+                engine,
+                table,
+                data,
+                batch_size=batch_size,
+                merge_policy=merge_policy,
+            )
+
+        # the rows not returned, for example ON CONFLICT DO NOTHING
+        missing = [pk for pk, row in results.items() if row is None]
+        if len(missing):
+            results.update(select_rows_by_pks(connection, table, missing))
+
+    rows = [row for row in results.values() if row is not None] + no_pk_rows
+    if as_dict:
+        return [dict(row._mapping) for row in rows]
+    return rows
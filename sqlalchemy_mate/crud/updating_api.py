@@ -2,3 +2,5 @@
 
 from .updating import update_all
 from .updating import upsert_all
+from .updating import get_upsert_insert
+from .updating import upsert_returning
@@ -14,6 +14,7 @@ def sql_to_csv(
     filepath: str,
     chunksize: int = 1000,
     overwrite: bool = False,
+    stream: bool = False,
 ):
     """
     Export sql stmt result to csv file.
@@ -23,11 +24,15 @@ def sql_to_csv(
     :param filepath: file path.
     :param chunksize: number of rows write to csv each time.
     :param overwrite: bool, if True, avoid to overite existing file.
+    :param stream: bool, if True, use server side cursor
+        (``stream_results=True, yield_per=chunksize``), the driver doesn't
+        buffer the full result set in client memory.
 
     **中文文档**
 
     将执行sql的结果中的所有数据, 以生成器的方式(一次只使用一小部分内存), 将
-    整个结果写入csv文件。
+    整个结果写入csv文件。如果 ``stream=True``, 则使用服务端游标, 数据库驱动也不会
+    在内存中缓存全部结果。
     """
     if overwrite:  # pragma: no cover
         if os.path.exists(filepath):
@@ -42,6 +47,8 @@ def sql_to_csv(
         df.to_csv(f, header=True, index=False)
 
         # iterate big database table
+        if stream:
+            stmt = stmt.execution_options(stream_results=True, yield_per=chunksize)
         with engine.connect() as connection:
             result_proxy = connection.execute(stmt)
             while True:
@@ -59,6 +66,7 @@ def table_to_csv(
     filepath,
     chunksize: int = 1000,
     overwrite: bool = False,
+    stream: bool = False,
 ):
     """
     Export entire table to a csv file.
@@ -68,10 +76,11 @@ def table_to_csv(
     :param filepath: file path.
     :param chunksize: number of rows write to csv each time.
     :param overwrite: bool, if True, avoid to overite existing file.
+    :param stream: bool, see :func:`sql_to_csv`.
 
     **中文文档**
 
     将整个表中的所有数据, 写入csv文件。
     """
     sql = sa.select(table)
-    sql_to_csv(sql, engine, filepath, chunksize)
+    sql_to_csv(sql, engine, filepath, chunksize, stream=stream)
@@ -18,12 +18,70 @@ from sqlalchemy.orm.exc import FlushError
 
 from ..utils import (
     ensure_exact_one_arg_is_not_none, ensure_list, grouper_list,
-    ensure_session, clean_session,
+    ensure_session, clean_session, BatchCommitter,
+    select_existing_pks, select_existing_rows,
+    get_max_rows_per_statement, get_pk_normalizer, pk_in_clause,
 )
+from ..crud.inserting import T_REJECTED_SINK, report_rejected
+from ..crud.selecting import _count_row, _sample_pks
 
 Base = declarative_base()
 
 
+def _split_insert_objects(
+    committer: BatchCommitter,
+    objs: List['ExtendedBase'],
+    minimal_size: int,
+    op_counter: int,
+    insert_counter: int,
+    rejected: T_REJECTED_SINK = None,
+) -> Tuple[int, int]:
+    """
+    The recursive "try bulk insert, then split" implementation of
+    :meth:`ExtendedBase.smart_insert`.
+    """
+    ses = committer.conn
+    # 首先进行尝试bulk insert
+    try:
+        with committer.attempt():
+            ses.add_all(objs)
+        committer.succeeded(len(objs))
+        op_counter += 1
+        insert_counter += len(objs)
+    # 失败了
+    except (IntegrityError, FlushError) as e:
+        # 分析数据量
+        n = len(objs)
+        # 只有一条数据, 则无需再次尝试
+        if n == 1:
+            report_rejected(rejected, objs[0], e)
+        # 如果数据条数多于一定数量
+        elif n >= minimal_size ** 2:
+            # 则进行分包
+            n_chunk = math.floor(math.sqrt(n))
+            for chunk in grouper_list(objs, n_chunk):
+                op_counter, insert_counter = _split_insert_objects(
+                    committer=committer,
+                    objs=chunk,
+                    minimal_size=minimal_size,
+                    op_counter=op_counter,
+                    insert_counter=insert_counter,
+                    rejected=rejected,
+                )
+        # 否则则一条条地逐条插入
+        else:
+            for obj in objs:
+                try:
+                    with committer.attempt():
+                        ses.add(obj)
+                    committer.succeeded(1)
+                    op_counter += 1
+                    insert_counter += 1
+                except (IntegrityError, FlushError) as e:
+                    report_rejected(rejected, obj, e)
+    return op_counter, insert_counter
+
+
 class ExtendedBase(Base):
     """
     Provide additional method.
@@ -354,6 +412,62 @@ class ExtendedBase(Base):
         clean_session(ses, auto_close)
         return obj
 
+    @classmethod
+    def by_pks(
+        cls,
+        engine_or_session: Union[Engine, Session],
+        ids: List[Union[Any, List[Any], Tuple]],
+    ) -> Dict[Any, Union['ExtendedBase', None]]:
+        """
+        Get many objects by primary_key values, with a few
+        ``SELECT ... WHERE pk IN (...)`` queries in one session. Keys are
+        chunked to the dialect's bound parameter limit.
+
+        Examples::
+
+            # OrderedDict([(1, User(id=1, name="Alice")), (2, None)])
+            print(User.by_pks(engine, [1, 2]))
+
+        :param ids: list of primary key values, each item has the same format
+            as the ``id_`` argument of :meth:`ExtendedBase.by_pk`.
+
+        :return: an ordered dict, key is the primary key value as given (list
+            is converted to tuple), value is the object, or None if not found.
+            The given values are converted by the column types before
+            matching, for example ``"1"`` finds the object of ``1``.
+
+        **中文文档**
+
+        允许用户一次用多个 primary key column 的值批量获取对象, 找不到的对象为 None.
+        """
+        ses, auto_close = ensure_session(engine_or_session)
+        n_pk = len(cls.pk_names())
+        # match the input values with what the database returns, e.g. "1" -> 1
+        normalize = get_pk_normalizer(
+            list(inspect(cls).primary_key), ses.get_bind().dialect
+        )
+        keys = OrderedDict()
+        for id_ in ids:
+            key = tuple(id_) if isinstance(id_, list) else id_
+            if isinstance(id_, (tuple, list)):
+                pk = tuple(id_)
+            else:
+                pk = (id_,)
+            if len(pk) != n_pk:
+                raise ValueError(
+                    "expect {} primary key values, got {!r}".format(n_pk, id_)
+                )
+            keys[key] = normalize(pk)
+
+        chunk_size = get_max_rows_per_statement(ses.get_bind().dialect, n_pk)
+        found = dict()
+        for chunk in grouper_list(list(set(keys.values())), chunk_size):
+            stmt = select(cls).where(pk_in_clause(cls.pk_fields(), chunk))
+            for obj in ses.scalars(stmt):
+                found[obj.pk_values()] = obj
+        clean_session(ses, auto_close)
+        return OrderedDict([(key, found.get(pk)) for key, pk in keys.items()])
+
     @classmethod
     def by_sql(
         cls,
@@ -407,15 +521,23 @@ class ExtendedBase(Base):
         engine_or_session: Union[Engine, Session],
         obj_or_objs: Union['ExtendedBase', List['ExtendedBase']],
         minimal_size: int = 5,
-        _op_counter: int = 0,
-        _insert_counter: int = 0,
+        use_savepoint: bool = False,
+        commit_every: int = None,
+        rejected: T_REJECTED_SINK = None,
     ) -> Tuple[int, int]:
         """
         An optimized Insert strategy.
 \
         :param minimal_size: internal bulk size for each attempts
-        :param _op_counter: number of successful bulk INSERT sql invoked
-        :param _insert_counter: number of successfully inserted objects.
+        :param use_savepoint: if True, run the whole operation in one outer
+            transaction, isolate each attempt with ``SAVEPOINT``, and commit
+            only once at the end. The write is atomic.
+        :param commit_every: only works with ``use_savepoint = True``, commit
+            every time at least ``commit_every`` objects are inserted.
+        :param rejected: where to send the objects that are not inserted, as
+            :class:`~sqlalchemy_mate.crud.inserting.RejectedRow`. It can be
+            a list, a callable, or a file writer like
+            :class:`~sqlalchemy_mate.crud.inserting.JsonLinesRejectWriter`.
 
         :return: number of bulk INSERT sql invoked. Usually it is
             greatly smaller than ``len(data)``. and also return the number of
@@ -423,8 +545,9 @@ class ExtendedBase(Base):
 
         .. warning::
 
-            This operation is not atomic, if you force stop the program,
-            then it could be only partially completed
+            This operation is not atomic unless ``use_savepoint = True``,
+            if you force stop the program, then it could be only partially
+            completed
 
         **中文文档**
 
@@ -440,58 +563,28 @@ class ExtendedBase(Base):
         但时间上是各种情况下平均最优的。
 
         1.4 以后的重要变化: session 变得更聪明了.
+
+        如果使用 ``use_savepoint=True``, 则整个操作在一个事务中完成, 每次尝试都用
+        SAVEPOINT 隔离, 最后只 commit 一次.
         """
         ses, auto_close = ensure_session(engine_or_session)
-
-        if isinstance(obj_or_objs, list):
-            # 首先进行尝试bulk insert
-            try:
-                ses.add_all(obj_or_objs)
-                ses.commit()
-                _op_counter += 1
-                _insert_counter += len(obj_or_objs)
-            # 失败了
-            except (IntegrityError, FlushError):
-                ses.rollback()
-                # 分析数据量
-                n = len(obj_or_objs)
-                # 如果数据条数多于一定数量
-                if n >= minimal_size ** 2:
-                    # 则进行分包
-                    n_chunk = math.floor(math.sqrt(n))
-                    for chunk in grouper_list(obj_or_objs, n_chunk):
-                        (
-                            _op_counter,
-                            _insert_counter,
-                        ) = cls.smart_insert(
-                            engine_or_session=ses,
-                            obj_or_objs=chunk,
-                            minimal_size=minimal_size,
-                            _op_counter=_op_counter,
-                            _insert_counter=_insert_counter,
-                        )
-                # 否则则一条条地逐条插入
-                else:
-                    for obj in obj_or_objs:
-                        try:
-                            ses.add(obj)
-                            ses.commit()
-                            _op_counter += 1
-                            _insert_counter += 1
-                        except (IntegrityError, FlushError):
-                            ses.rollback()
-        else:
-            try:
-                ses.add(obj_or_objs)
-                ses.commit()
-                _op_counter += 1
-                _insert_counter += 1
-            except (IntegrityError, FlushError):
-                ses.rollback()
-
+        committer = BatchCommitter(
+            ses,
+            use_savepoint=use_savepoint,
+            commit_every=commit_every,
+            errors=(IntegrityError, FlushError),
+        )
+        op_counter, insert_counter = _split_insert_objects(
+            committer=committer,
+            objs=ensure_list(obj_or_objs),
+            minimal_size=minimal_size,
+            op_counter=0,
+            insert_counter=0,
+            rejected=rejected,
+        )
+        committer.finish()
         clean_session(ses, auto_close)
-
-        return _op_counter, _insert_counter
+        return op_counter, insert_counter
 
     @classmethod
     def update_all(
@@ -500,10 +593,18 @@ class ExtendedBase(Base):
         obj_or_objs: Union['ExtendedBase', List['ExtendedBase']],
         include_null: bool = True,
         upsert: bool = False,
-    ) -> Tuple[int, int]:
+        skip_unchanged: bool = False,
+        hash_column: str = None,
+        batch_size: int = 1000,
+    ) -> Union[Tuple[int, int], Tuple[int, int, int]]:
         """
         The :meth:`sqlalchemy.crud.updating.update_all` function in ORM syntax.
 
+        The objects that match nothing are found with one keyed SELECT, the
+        others are updated with ORM bulk UPDATE by primary key
+        ``session.execute(update(cls), [dict, ...])``, one executemany per
+        ``batch_size`` objects.
+
         This operation **IS NOT ATOMIC**. It is a greedy operation, trying to
         update as much as it can.
 
@@ -511,31 +612,72 @@ class ExtendedBase(Base):
         :param obj_or_objs: single object or list of object
         :param include_null: update those None value field or not
         :param upsert: if True, then do insert also.
+        :param skip_unchanged: if True, fetch the existing rows with one keyed
+            SELECT per chunk, and only update the objects that differ from
+            what is already stored.
+        :param hash_column: if given, compare the objects by this column only
+            instead of column by column.
+        :param batch_size: number of objects in one bulk UPDATE.
 
-        :return: number of row been changed
+        :return: number of row been changed. If ``skip_unchanged`` is True,
+            return number of rows updated, inserted and unchanged.
         """
         update_counter = 0
         insert_counter = 0
+        unchanged_counter = 0
 
         ses, auto_close = ensure_session(engine_or_session)
 
         obj_or_objs = ensure_list(obj_or_objs)  # type: List[ExtendedBase]
 
+        if skip_unchanged:
+            existing = select_existing_rows(
+                ses.connection(),
+                cls.__table__,
+                [obj.pk_values() for obj in obj_or_objs],
+                columns=None if hash_column is None else [hash_column],
+            )
+            objs_to_write = list()
+            for obj in obj_or_objs:
+                stored = existing.get(obj.pk_values())
+                if stored is None:
+                    objs_to_write.append(obj)
+                elif hash_column is not None:
+                    if getattr(obj, hash_column) == stored[hash_column]:
+                        unchanged_counter += 1
+                    else:
+                        objs_to_write.append(obj)
+                elif all([
+                    stored.get(key) == value
+                    for key, value in obj.to_dict(include_null=include_null).items()
+                ]):
+                    unchanged_counter += 1
+                else:
+                    objs_to_write.append(obj)
+            obj_or_objs = objs_to_write
+
+        # find the objects that match nothing with one keyed SELECT
+        if skip_unchanged:
+            existing_pks = set(existing)
+        else:
+            existing_pks = select_existing_pks(
+                ses.connection(),
+                cls.__table__,
+                [obj.pk_values() for obj in obj_or_objs],
+            )
+        rows_to_update = list()
         objs_to_insert = list()
         for obj in obj_or_objs:
-            res = ses.execute(
-                update(cls).
-                    where(*[
-                    field == value
-                    for field, value in zip(obj.pk_fields(), obj.pk_values())
-                ]).
-                    values(**obj.to_dict(include_null=include_null))
-            )
-            if res.rowcount:
-                update_counter += 1
+            if obj.pk_values() in existing_pks:
+                rows_to_update.append(obj.to_dict(include_null=include_null))
             else:
                 objs_to_insert.append(obj)
 
+        # ORM bulk UPDATE by primary key, one executemany per chunk
+        for rows in grouper_list(rows_to_update, batch_size):
+            ses.execute(update(cls), rows)
+        update_counter += len(rows_to_update)
+
         if upsert:
             try:
                 ses.add_all(objs_to_insert)
@@ -548,6 +690,8 @@ class ExtendedBase(Base):
 
         clean_session(ses, auto_close)
 
+        if skip_unchanged:
+            return update_counter, insert_counter, unchanged_counter
         return update_counter, insert_counter
 
     @classmethod
@@ -556,13 +700,19 @@ class ExtendedBase(Base):
         engine_or_session: Union[Engine, Session],
         obj_or_objs: Union['ExtendedBase', List['ExtendedBase']],
         include_null: bool = True,
-    ) -> Tuple[int, int]:
+        skip_unchanged: bool = False,
+        hash_column: str = None,
+        batch_size: int = 1000,
+    ) -> Union[Tuple[int, int], Tuple[int, int, int]]:
         """
         The :meth:`sqlalchemy.crud.updating.upsert_all` function in ORM syntax.
 
         :param engine_or_session: an engine created by``sqlalchemy.create_engine``.
         :param obj_or_objs: single object or list of object
         :param include_null: update those None value field or not
+        :param skip_unchanged: see :meth:`ExtendedBase.update_all`.
+        :param hash_column: see :meth:`ExtendedBase.update_all`.
+        :param batch_size: see :meth:`ExtendedBase.update_all`.
 
         :return: number of row been changed
         """
@@ -571,6 +721,9 @@ class ExtendedBase(Base):
             obj_or_objs=obj_or_objs,
             include_null=include_null,
             upsert=True,
+            skip_unchanged=skip_unchanged,
+            hash_column=hash_column,
+            batch_size=batch_size,
         )
 
     @classmethod
@@ -592,12 +745,27 @@ class ExtendedBase(Base):
     def count_all(
         cls,
         engine_or_session: Union[Engine, Session],
+        approximate: bool = False,
+        cache_ttl: float = None,
     ) -> int:
         """
         Return number of rows in this table.
+
+        :param approximate: if True, read the estimated number of rows from the
+            planner statistics, see :func:`sqlalchemy_mate.crud.selecting.count_row`.
+        :param cache_ttl: if given, cache the count in memory for ``cache_ttl``
+            seconds.
         """
         ses, auto_close = ensure_session(engine_or_session)
-        count = ses.execute(select(func.count()).select_from(cls)).one()[0]
+        if approximate or (cache_ttl is not None):
+            count = _count_row(
+                ses.connection(),
+                cls.__table__,
+                approximate=approximate,
+                cache_ttl=cache_ttl,
+            )
+        else:
+            count = ses.execute(select(func.count()).select_from(cls)).one()[0]
         clean_session(ses, auto_close)
         return count
 
@@ -620,31 +788,30 @@ class ExtendedBase(Base):
         engine_or_session: Union[Engine, Session],
         limit: int = None,
         perc: int = None,
+        strategy: str = None,
     ) -> List['ExtendedBase']:
         """
         Return random ORM instance.
 
+        :param strategy: the sampling strategy, by default the one that fits
+            the dialect and the table is used, see
+            :func:`sqlalchemy_mate.crud.selecting.select_random`.
+
         :rtype: List[ExtendedBase]
         """
         ses, auto_close = ensure_session(engine_or_session)
         ensure_exact_one_arg_is_not_none(limit, perc)
-        if limit is not None:
-            results = ses.scalars(
-                select(cls).order_by(func.random()).limit(limit)
-            ).all()
-        elif perc is not None:
-            selectable = cls.__table__.tablesample(
-                func.bernoulli(perc),
-                name="alias",
-                seed=func.random()
-            )
-            args = [
-                getattr(selectable.c, column.name)
-                for column in cls.__table__.columns
-            ]
-            stmt = select(*args)
-            results = [cls(**row._asdict()) for row in ses.execute(stmt)]
-        else:
-            raise ValueError
+        pks = _sample_pks(
+            ses.connection(),
+            cls.__table__,
+            limit=limit,
+            perc=perc,
+            strategy=strategy,
+        )
+        results = [
+            obj
+            for obj in cls.by_pks(ses, pks).values()
+            if obj is not None
+        ]
         clean_session(ses, auto_close)
         return results
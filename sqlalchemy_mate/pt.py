@@ -21,6 +21,7 @@ import sqlalchemy.orm as orm
 from prettytable import PrettyTable
 
 from .utils import ensure_session, clean_session
+from .crud.selecting import SelectionHandle
 
 
 def get_keys_values(
@@ -65,9 +66,8 @@ def from_text_clause(t: sa.TextClause, engine: sa.Engine, **kwargs) -> PrettyTab
     Execute a query in form of texture clause, return the result in form of
     :class:`PrettyTable`.
     """
-    with engine.connect() as connection:
-        result = connection.execute(t, **kwargs)
-        return from_result(result)
+    with SelectionHandle(engine, t, **kwargs) as handle:
+        return from_result(handle.result)
 
 
 def from_stmt(stmt: sa.Select, engine: sa.Engine, **kwargs) -> PrettyTable:
@@ -81,9 +81,8 @@ def from_stmt(stmt: sa.Select, engine: sa.Engine, **kwargs) -> PrettyTable:
 
     将 sqlalchemy 的 sql expression query 结果放入 prettytable 中.
     """
-    with engine.connect() as connection:
-        result = connection.execute(stmt, **kwargs)
-        return from_result(result)
+    with SelectionHandle(engine, stmt, **kwargs) as handle:
+        return from_result(handle.result)
 
 
 def from_table(
@@ -105,9 +104,8 @@ def from_table(
     stmt = sa.select(table)
     if limit is not None:
         stmt = stmt.limit(limit)
-    with engine.connect() as connection:
-        result = connection.execute(stmt, **kwargs)
-        return from_result(result)
+    with SelectionHandle(engine, stmt, **kwargs) as handle:
+        return from_result(handle.result)
 
 
 def from_model(
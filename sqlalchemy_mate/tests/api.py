@@ -9,6 +9,7 @@ from .crud_test import t_inv
 from .crud_test import t_smart_insert
 from .crud_test import t_cache
 from .crud_test import t_graph
+from .crud_test import t_doc
 from .crud_test import User
 from .crud_test import Association
 from .crud_test import Order
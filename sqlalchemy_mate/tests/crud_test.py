@@ -46,6 +46,15 @@ t_graph = sa.Table(
     sa.Column("value", sa.Integer),
 )
 
+t_doc = sa.Table(
+    "t_document",
+    metadata,
+    sa.Column("doc_id", sa.Integer, primary_key=True),
+    sa.Column("version", sa.Integer),
+    sa.Column("updated_at", sa.DateTime),
+    sa.Column("body", sa.String),
+)
+
 # --- Orm
 Base = orm.declarative_base()
 
@@ -177,6 +186,7 @@ class BaseCrudTest:
             connection.execute(t_cache.delete())
             connection.execute(t_graph.delete())
             connection.execute(t_smart_insert.delete())
+            connection.execute(t_doc.delete())
             connection.commit()
 
     @classmethod
@@ -5,9 +5,11 @@ Utilities function.
 """
 
 import typing as T
+import contextlib
 
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
+from sqlalchemy.exc import IntegrityError
 
 
 def ensure_exact_one_arg_is_not_none(*args):
@@ -57,6 +59,296 @@ def grouper_list(l: T.Iterable, n: int) -> T.Iterable[list]:
         yield chunk
 
 
+def get_pk_value(
+    pk_names: T.Sequence[str],
+    row: T.Dict[str, T.Any],
+) -> tuple:
+    """
+    Extract the primary key values from a row dict in form of tuple, missing
+    primary key value is None.
+    """
+    return tuple([row.get(name) for name in pk_names])
+
+
+def get_pk_normalizer(
+    pk_cols: T.List[sa.Column],
+    dialect: sa.Dialect,
+) -> T.Callable[[tuple], tuple]:
+    """
+    Return a function that converts the python side primary key values to
+    what the database returns, by running them through the column type's
+    bind and result processors, then the type's python type. For example,
+    ``"1"`` in an Integer column becomes ``1``.
+    """
+    processors = list()
+    for col in pk_cols:
+        bind = col.type.bind_processor(dialect)
+        result = col.type.result_processor(dialect, None)
+        try:
+            python_type = col.type.python_type
+        except NotImplementedError:  # pragma: no cover
+            python_type = None
+        processors.append((bind, result, python_type))
+
+    def normalize(pk: tuple) -> tuple:
+        values = list()
+        for value, (bind, result, python_type) in zip(pk, processors):
+            try:
+                if bind is not None:
+                    value = bind(value)
+                if result is not None:
+                    value = result(value)
+                if (python_type is not None) and (not isinstance(value, python_type)):
+                    value = python_type(value)
+            except (TypeError, ValueError):
+                pass
+            values.append(value)
+        return tuple(values)
+
+    return normalize
+
+
+def get_max_bind_params(dialect: sa.Dialect) -> int:
+    """
+    The max number of bound parameters allowed in one SQL statement.
+
+    - SQLite: 999 before 3.32.0, 32766 after.
+    - MSSQL: 2100, minus one for safety.
+    - PostgreSQL: 32767, the wire protocol uses a 16 bit integer.
+    - MySQL: 65535.
+    - Others: 999, conservative.
+    """
+    if dialect.name == "sqlite":
+        import sqlite3
+
+        if sqlite3.sqlite_version_info < (3, 32, 0):  # pragma: no cover
+            return 999
+        else:
+            return 32766
+    elif dialect.name == "mssql":
+        return 2099
+    elif dialect.name == "postgresql":
+        return 32767
+    elif dialect.name in ("mysql", "mariadb"):
+        return 65535
+    else:  # pragma: no cover
+        return 999
+
+
+def get_max_rows_per_statement(
+    dialect: sa.Dialect,
+    n_columns: int,
+) -> int:
+    """
+    The max number of rows in a multi rows ``VALUES`` / ``IN`` clause without
+    tripping the "too many SQL variables" error.
+    """
+    return max(1, get_max_bind_params(dialect) // max(1, n_columns))
+
+
+def pk_in_clause(
+    pk_cols: T.Sequence[sa.ColumnElement],
+    pk_values: T.Sequence[tuple],
+) -> sa.ColumnElement:
+    """
+    The ``pk IN (...)`` clause, tuple IN ``(a, b) IN ((1, 2), ...)`` is used
+    for composite primary key.
+
+    :param pk_cols: primary key columns, or ORM attributes.
+    :param pk_values: list of primary key values tuple.
+    """
+    if len(pk_cols) == 1:
+        return pk_cols[0].in_([pk[0] for pk in pk_values])
+    else:
+        return sa.tuple_(*pk_cols).in_(pk_values)
+
+
+def select_existing_pks(
+    connection: sa.Connection,
+    table: sa.Table,
+    pk_values: T.Iterable[tuple],
+    chunk_size: T.Optional[int] = None,
+) -> T.Set[tuple]:
+    """
+    Find out which primary key values already exist in the table, use one
+    ``SELECT pk FROM table WHERE pk IN (...)`` query per chunk. Tuple IN is used
+    for composite primary key.
+
+    :param pk_values: list of primary key values tuple, the order of value
+        in the tuple has to match the order of ``table.primary_key``.
+    :param chunk_size: max number of primary key values in one query, by default
+        it is sized to the dialect's bound parameter limit.
+
+    **中文文档**
+
+    用一次 (或数次, 取决于 ``chunk_size``) 基于主键索引的查询, 找出哪些主键已经存在.
+    """
+    pk_cols = list(table.primary_key)
+    if chunk_size is None:
+        chunk_size = get_max_rows_per_statement(connection.dialect, len(pk_cols))
+    existing = set()
+    for chunk in grouper_list(pk_values, chunk_size):
+        stmt = sa.select(*pk_cols).where(pk_in_clause(pk_cols, chunk))
+        for row in connection.execute(stmt):
+            existing.add(tuple(row))
+    return existing
+
+
+def select_rows_by_pks(
+    connection: sa.Connection,
+    table: sa.Table,
+    pk_values: T.Iterable[tuple],
+    columns: T.Optional[T.Iterable[str]] = None,
+    chunk_size: T.Optional[int] = None,
+) -> T.Dict[tuple, sa.Row]:
+    """
+    Fetch the existing rows by primary key values, use one
+    ``SELECT ... FROM table WHERE pk IN (...)`` query per chunk. Tuple IN is
+    used for composite primary key.
+
+    :param pk_values: list of primary key values tuple, the order of value
+        in the tuple has to match the order of ``table.primary_key``.
+    :param columns: the column names to fetch, primary key columns are always
+        included. None means all columns.
+    :param chunk_size: max number of primary key values in one query, by default
+        it is sized to the dialect's bound parameter limit.
+
+    :return: a dict, key is the primary key values tuple, value is the row.
+
+    **中文文档**
+
+    用基于主键索引的查询, 批量取得已经存在的行.
+    """
+    pk_cols = list(table.primary_key)
+    pk_names = [col.name for col in pk_cols]
+    if columns is None:
+        cols = list(table.columns)
+    else:
+        cols = pk_cols + [table.c[name] for name in columns if name not in pk_names]
+    if chunk_size is None:
+        chunk_size = get_max_rows_per_statement(connection.dialect, len(pk_cols))
+    existing = dict()
+    for chunk in grouper_list(pk_values, chunk_size):
+        stmt = sa.select(*cols).where(pk_in_clause(pk_cols, chunk))
+        for row in connection.execute(stmt):
+            existing[get_pk_value(pk_names, row._mapping)] = row
+    return existing
+
+
+def select_existing_rows(
+    connection: sa.Connection,
+    table: sa.Table,
+    pk_values: T.Iterable[tuple],
+    columns: T.Optional[T.Iterable[str]] = None,
+    chunk_size: T.Optional[int] = None,
+) -> T.Dict[tuple, T.Dict[str, T.Any]]:
+    """
+    Same as :func:`select_rows_by_pks`, but the row is in form of dict.
+    """
+    rows = select_rows_by_pks(
+        connection,
+        table,
+        pk_values,
+        columns=columns,
+        chunk_size=chunk_size,
+    )
+    return {pk: dict(row._mapping) for pk, row in rows.items()}
+
+
+def begin_dbapi_transaction(connection: sa.Connection):
+    """
+    Make sure the DBAPI connection is in a real transaction.
+
+    The pysqlite driver doesn't emit ``BEGIN`` until the first DML statement,
+    so a ``SAVEPOINT`` issued first becomes the outermost transaction and
+    ``RELEASE SAVEPOINT`` commits it. Emit ``BEGIN`` explicitly in this case.
+    """
+    if connection.dialect.name == "sqlite":
+        dbapi_connection = connection.connection.dbapi_connection
+        if not getattr(dbapi_connection, "in_transaction", True):
+            connection.exec_driver_sql("BEGIN")
+
+
+class BatchCommitter:
+    """
+    Run each batch write as an isolated unit, and decide when to commit.
+
+    - ``use_savepoint = False``: commit after every succeeded batch, rollback
+        the whole transaction after every failed batch.
+    - ``use_savepoint = True``: run everything in one outer transaction, isolate
+        each batch with ``SAVEPOINT`` / ``ROLLBACK TO SAVEPOINT``, commit when
+        :meth:`finish` is called, or every ``commit_every`` rows.
+
+    :param conn: a :class:`sqlalchemy.Connection` or :class:`sqlalchemy.orm.Session`.
+
+    **中文文档**
+
+    负责每一批写入的事务隔离, 以及何时 commit. 在 savepoint 模式下, 所有的写入都在
+    同一个事务中完成, 失败的批次只回滚到 savepoint, 只在最后 (或者每写入
+    ``commit_every`` 行) commit 一次.
+    """
+
+    def __init__(
+        self,
+        conn: T.Union[sa.Connection, orm.Session],
+        use_savepoint: bool = False,
+        commit_every: T.Optional[int] = None,
+        errors: T.Tuple[T.Type[Exception], ...] = (IntegrityError,),
+    ):
+        self.conn = conn
+        self.use_savepoint = use_savepoint
+        self.commit_every = commit_every
+        self.errors = errors
+        self.n_pending_rows = 0
+
+    def _begin(self):
+        if isinstance(self.conn, orm.Session):
+            begin_dbapi_transaction(self.conn.connection())
+        else:
+            begin_dbapi_transaction(self.conn)
+
+    @contextlib.contextmanager
+    def attempt(self):
+        """
+        Run the batch write in the ``with`` block, if it failed with one of the
+        ``errors``, roll it back and re-raise the error.
+        """
+        if self.use_savepoint:
+            self._begin()
+            savepoint = self.conn.begin_nested()
+            try:
+                yield
+                savepoint.commit()
+            except self.errors:
+                savepoint.rollback()
+                raise
+        else:
+            try:
+                yield
+                self.conn.commit()
+            except self.errors:
+                self.conn.rollback()
+                raise
+
+    def succeeded(self, n_rows: int):
+        """
+        Report that ``n_rows`` rows have been written by the last attempt.
+        """
+        if self.use_savepoint and self.commit_every is not None:
+            self.n_pending_rows += n_rows
+            if self.n_pending_rows >= self.commit_every:
+                self.conn.commit()
+                self.n_pending_rows = 0
+
+    def finish(self):
+        """
+        Commit the outer transaction in savepoint mode.
+        """
+        if self.use_savepoint:
+            self.conn.commit()
+            self.n_pending_rows = 0
+
+
 session_klass_cache: T.Dict[int, T.Type[orm.Session]] = dict()
 
 
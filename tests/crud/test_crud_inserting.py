@@ -1,23 +1,66 @@
 # -*- coding: utf-8 -*-
 
+import csv
+import contextlib
+import json
 import random
 import time
 
 import pytest
 from sqlalchemy.exc import IntegrityError
 
-from sqlalchemy_mate.crud.inserting import smart_insert
+from sqlalchemy_mate.crud.inserting import (
+    AdaptiveBatchSizer,
+    RejectedRow,
+    JsonLinesRejectWriter,
+    CsvRejectWriter,
+    smart_insert,
+    bulk_copy,
+)
 from sqlalchemy_mate.crud.selecting import count_row
 from sqlalchemy_mate.tests.api import (
     IS_WINDOWS,
     engine_sqlite,
     engine_psql,
+    t_user,
+    t_inv,
     t_smart_insert,
     BaseCrudTest,
 )
 
 
+def test_adaptive_batch_sizer():
+    sizer = AdaptiveBatchSizer(initial_size=10, max_size=1000)
+    # slow start
+    sizer.succeeded(10, 0.01)
+    assert sizer.size == 20
+    sizer.succeeded(20, 0.01)
+    assert sizer.size == 40
+    # multiplicative decrease
+    sizer.failed(40)
+    assert sizer.size == 20
+    assert sizer.threshold == 20
+    assert sizer.error_rate > 0
+    # congestion avoidance, grow slower than slow start
+    sizer.succeeded(20, 0.01)
+    assert 20 < sizer.size < 40
+    # too slow
+    size = sizer.size
+    sizer.succeeded(size, 10.0)
+    assert sizer.size == size // 2
+    # never below min_size
+    for _ in range(20):
+        sizer.failed(1)
+    assert sizer.size == 1
+
+
 class InsertingApiBaseTest(BaseCrudTest):
+    def method_level_data_setup(self):
+        """
+        Make sure each test case starts with empty tables.
+        """
+        self.delete_all_data_in_core_table()
+
     def teardown_method(self, method):
         """
         Make sure data in all table is cleared after each test cases.
@@ -105,10 +148,358 @@ class InsertingApiBaseTest(BaseCrudTest):
         assert ins_count == 0
         assert count_row(self.engine, t_smart_insert) == 1
 
+    def test_smart_insert_on_conflict(self):
+        exist_data = [{"id": id} for id in range(1, 1000 + 1, 10)]
+        all_data = [{"id": id} for id in range(1, 1000 + 1)]
+
+        op_count, ins_count = smart_insert(
+            self.engine, t_smart_insert, exist_data, strategy="on_conflict"
+        )
+        assert op_count == 1
+        assert ins_count == 100
+
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            all_data,
+            strategy="on_conflict",
+            batch_size=300,
+        )
+        assert op_count == 4
+        assert ins_count == 900
+        assert count_row(self.engine, t_smart_insert) == 1000
+
+        op_count, ins_count = smart_insert(
+            self.engine, t_smart_insert, {"id": 1}, strategy="on_conflict"
+        )
+        assert op_count == 1
+        assert ins_count == 0
+
+        with pytest.raises(ValueError):
+            smart_insert(self.engine, t_smart_insert, all_data, strategy="invalid")
+
+        # more rows than the bind parameter limit allows in one statement
+        many_data = [{"id": id} for id in range(1, 40000 + 1)]
+        op_count, ins_count = smart_insert(
+            self.engine, t_smart_insert, many_data, strategy="on_conflict"
+        )
+        assert op_count == 2
+        assert ins_count == 39000
+        assert count_row(self.engine, t_smart_insert) == 40000
+
+    def test_smart_insert_prefilter(self):
+        exist_data = [{"id": id} for id in range(1, 1000 + 1, 10)]
+        all_data = [{"id": id} for id in range(1, 1000 + 1)]
+        smart_insert(self.engine, t_smart_insert, exist_data)
+
+        # duplicate rows in the input data are dropped too
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            all_data + all_data[:10],
+            batch_size=500,
+            prefilter=True,
+        )
+        assert op_count == 2  # the last chunk only has duplicate rows
+        assert ins_count == 900
+        assert count_row(self.engine, t_smart_insert) == 1000
+
+        # all rows already exist, no INSERT at all
+        op_count, ins_count = smart_insert(
+            self.engine, t_smart_insert, all_data, prefilter=True
+        )
+        assert op_count == 0
+        assert ins_count == 0
+
+        # composite primary key
+        smart_insert(self.engine, t_inv, [{"store_id": 1, "item_id": 1}])
+        data = [
+            {"store_id": store_id, "item_id": item_id}
+            for store_id in range(1, 1 + 3)
+            for item_id in range(1, 1 + 3)
+        ]
+        op_count, ins_count = smart_insert(self.engine, t_inv, data, prefilter=True)
+        assert op_count == 1
+        assert ins_count == 8
+        assert count_row(self.engine, t_inv) == 9
+
+    def test_smart_insert_use_savepoint(self):
+        exist_data = [{"id": id} for id in range(1, 1000 + 1, 10)]
+        all_data = [{"id": id} for id in range(1, 1000 + 1)]
+        smart_insert(self.engine, t_smart_insert, exist_data)
+
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            all_data,
+            use_savepoint=True,
+        )
+        assert ins_count == 900
+        assert count_row(self.engine, t_smart_insert) == 1000
+
+        # the write is atomic, nothing is committed if it failed in the middle
+        self.delete_all_data_in_core_table()
+        data = [{"id": id} for id in range(1, 20 + 1)] + [{"id": object()}]
+        with pytest.raises(Exception):
+            smart_insert(
+                self.engine,
+                t_smart_insert,
+                data,
+                batch_size=10,
+                use_savepoint=True,
+            )
+        assert count_row(self.engine, t_smart_insert) == 0
+
+        # unless commit_every is set
+        with pytest.raises(Exception):
+            smart_insert(
+                self.engine,
+                t_smart_insert,
+                data,
+                batch_size=10,
+                use_savepoint=True,
+                commit_every=10,
+            )
+        assert count_row(self.engine, t_smart_insert) == 20
+
+    def test_smart_insert_iterator(self):
+        smart_insert(self.engine, t_smart_insert, [{"id": 1}, {"id": 500}])
+
+        progress = list()
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            ({"id": id} for id in range(1, 1000 + 1)),
+            batch_size=300,
+            progress_callback=lambda *args: progress.append(args),
+        )
+        assert ins_count == 998
+        assert count_row(self.engine, t_smart_insert) == 1000
+        assert [n for n, _, _ in progress] == [300, 600, 900, 1000]
+        assert progress[-1] == (1000, op_count, ins_count)
+
+        # empty iterator
+        assert smart_insert(self.engine, t_smart_insert, iter([])) == (0, 0)
+        assert smart_insert(self.engine, t_smart_insert, []) == (0, 0)
+
+    def test_smart_insert_adaptive(self):
+        exist_data = [{"id": id} for id in range(1, 1000 + 1, 100)]
+        smart_insert(self.engine, t_smart_insert, exist_data)
+
+        sizer = AdaptiveBatchSizer(initial_size=16)
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            [{"id": id} for id in range(1, 1000 + 1)],
+            strategy="adaptive",
+            sizer=sizer,
+        )
+        assert ins_count == 990
+        assert op_count < 990
+        assert count_row(self.engine, t_smart_insert) == 1000
+
+        # clean data use large batch
+        sizer = AdaptiveBatchSizer(initial_size=16)
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            [{"id": id} for id in range(1001, 3000 + 1)],
+            strategy="adaptive",
+            sizer=sizer,
+        )
+        assert ins_count == 2000
+        assert op_count <= 8
+        assert sizer.size > 1000
+
+        # the failed batch is still split when the sizer is clamped by min_size
+        smart_insert(self.engine, t_smart_insert, [{"id": 5000}])
+        sizer = AdaptiveBatchSizer(initial_size=20, min_size=10)
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            [{"id": id} for id in range(4981, 5020 + 1)],
+            strategy="adaptive",
+            sizer=sizer,
+        )
+        assert ins_count == 39
+        assert count_row(self.engine, t_smart_insert) == 3040
+
+    def test_smart_insert_bisect(self):
+        exist_ids = [3, 500, 777]
+        smart_insert(self.engine, t_smart_insert, [{"id": id} for id in exist_ids])
+
+        rejected = list()
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            [{"id": id} for id in range(1, 1000 + 1)],
+            strategy="bisect",
+            rejected=rejected,
+        )
+        assert ins_count == 997
+        # about k * log2(n) statements
+        assert op_count <= 3 * 10
+        assert count_row(self.engine, t_smart_insert) == 1000
+        assert [r.row["id"] for r in rejected] == exist_ids
+        for r in rejected:
+            assert isinstance(r, RejectedRow)
+            assert issubclass(r.error_class, Exception)
+
+    def test_smart_insert_rejected(self):
+        smart_insert(self.engine, t_smart_insert, [{"id": 2}, {"id": 4}])
+        data = [{"id": id} for id in range(1, 6 + 1)] + [{"id": 1}]
+        for kwargs in [
+            dict(strategy="split"),
+            dict(strategy="adaptive"),
+            dict(strategy="on_conflict"),
+            dict(prefilter=True),
+        ]:
+            rejected = list()
+            op_count, ins_count = smart_insert(
+                self.engine, t_smart_insert, data, rejected=rejected, **kwargs
+            )
+            assert sorted([r.row["id"] for r in rejected]) == [1, 2, 4]
+            assert ins_count == 7 - len(rejected)
+            # reset
+            self.delete_all_data_in_core_table()
+            smart_insert(self.engine, t_smart_insert, [{"id": 2}, {"id": 4}])
+
+    def test_smart_insert_on_conflict_rejected_autoincrement(self):
+        # the primary key is generated by the database
+        rejected = list()
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_user,
+            [{"name": "a"}, {"name": "b"}],
+            strategy="on_conflict",
+            rejected=rejected,
+        )
+        assert (op_count, ins_count) == (1, 2)
+        assert rejected == []
+        assert count_row(self.engine, t_user) == 2
+
+    def test_smart_insert_rejected_sink(self, tmp_path):
+        smart_insert(self.engine, t_smart_insert, [{"id": 2}, {"id": 4}])
+        data = [{"id": id} for id in range(1, 6 + 1)]
+
+        # callable
+        rejected = list()
+        smart_insert(self.engine, t_smart_insert, data, rejected=rejected.append)
+        assert [r.row["id"] for r in rejected] == [2, 4]
+        assert rejected[0].error_name.endswith(rejected[0].error_class.__name__)
+
+        # json lines file
+        path = tmp_path / "rejected.jsonl"
+        with JsonLinesRejectWriter(str(path)) as writer:
+            smart_insert(self.engine, t_smart_insert, data, rejected=writer)
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [record["row"] for record in records] == data
+        assert records[0]["error_class"] == rejected[0].error_name
+
+        # csv file
+        path = tmp_path / "rejected.csv"
+        with CsvRejectWriter(str(path)) as writer:
+            smart_insert(self.engine, t_smart_insert, data, rejected=writer)
+        with path.open() as f:
+            records = list(csv.DictReader(f))
+        assert [record["id"] for record in records] == [str(i) for i in range(1, 7)]
+        assert records[0]["error_class"] == rejected[0].error_name
+
+        # reusing the writer appends to the file
+        with writer:
+            smart_insert(self.engine, t_smart_insert, data[:2], rejected=writer)
+        with path.open() as f:
+            records = list(csv.DictReader(f))
+        assert [record["id"] for record in records] == [
+            "1",
+            "2",
+            "3",
+            "4",
+            "5",
+            "6",
+            "1",
+            "2",
+        ]
+
+        # the writer has to be opened with ``with``
+        with pytest.raises(RuntimeError):
+            writer(rejected[0])
+
+    def test_smart_insert_workers(self):
+        exist_data = [{"id": id} for id in range(1, 1000 + 1, 10)]
+        smart_insert(self.engine, t_smart_insert, exist_data)
+
+        rejected = list()
+        progress = list()
+        if self.engine.dialect.name == "sqlite":
+            context = pytest.warns(UserWarning, match="one writer")
+        else:
+            context = contextlib.nullcontext()
+        with context:
+            op_count, ins_count = smart_insert(
+                self.engine,
+                t_smart_insert,
+                ({"id": id} for id in range(1, 1000 + 1)),
+                strategy="bisect",
+                batch_size=500,
+                rejected=rejected,
+                progress_callback=lambda *args: progress.append(args),
+                workers=4,
+            )
+        assert ins_count == 900
+        assert count_row(self.engine, t_smart_insert) == 1000
+        assert sorted([r.row["id"] for r in rejected]) == [
+            row["id"] for row in exist_data
+        ]
+        assert progress[-1] == (1000, op_count, ins_count)
+
+        with pytest.raises(ValueError):
+            smart_insert(
+                self.engine, t_smart_insert, exist_data, workers=4, use_savepoint=True
+            )
+
 
 class TestInsertingApiSqlite(InsertingApiBaseTest):
     engine = engine_sqlite
 
+    def test_smart_insert_on_conflict_not_null(self):
+        # NOT NULL violation is not a conflict, the statement is split.
+        # pg8000 raises ProgrammingError for it, so it's only tested on sqlite
+        data = [{"store_id": 1, "item_id": id} for id in range(1, 10 + 1)]
+        bad_row = {"store_id": 100, "item_id": None}
+        for with_rejected in [False, True]:
+            rejected = list() if with_rejected else None
+            op_count, ins_count = smart_insert(
+                self.engine,
+                t_inv,
+                data + [bad_row],
+                strategy="on_conflict",
+                rejected=rejected,
+            )
+            assert ins_count == 10
+            assert count_row(self.engine, t_inv) == 10
+            if with_rejected:
+                assert [r.row for r in rejected] == [bad_row]
+            self.delete_all_data_in_core_table()
+
+    def test_smart_insert_on_conflict_rejected_coerced_pk(self):
+        # the driver stores "2" as 2 in the Integer column
+        smart_insert(self.engine, t_smart_insert, [{"id": 1}])
+        rejected = list()
+        op_count, ins_count = smart_insert(
+            self.engine,
+            t_smart_insert,
+            [{"id": "1"}, {"id": "2"}],
+            strategy="on_conflict",
+            rejected=rejected,
+        )
+        assert ins_count == 1
+        assert [r.row for r in rejected] == [{"id": "1"}]
+
+    def test_bulk_copy(self):
+        with pytest.raises(NotImplementedError):
+            bulk_copy(self.engine, t_user, [{"user_id": 1}])
+
 
 @pytest.mark.skipif(
     IS_WINDOWS,
@@ -117,6 +508,26 @@ class TestInsertingApiSqlite(InsertingApiBaseTest):
 class TestInsertingApiPostgres(InsertingApiBaseTest):
     engine = engine_psql
 
+    def test_bulk_copy(self):
+        data = [
+            {"user_id": 1, "name": "Alice"},
+            {"user_id": 2, "name": None},
+            {"user_id": 3, "name": ""},
+            {"user_id": 4, "name": 'a "quoted", multi\nline name'},
+        ]
+        assert bulk_copy(self.engine, t_user, (row for row in data)) == 4
+        with self.engine.connect() as connection:
+            rows = connection.execute(t_user.select().order_by(t_user.c.user_id))
+            assert [row._asdict() for row in rows] == data
+
+        # deduplicate with staging table
+        data = [{"user_id": user_id} for user_id in range(1, 10 + 1)]
+        n = bulk_copy(self.engine, t_user, data, on_conflict_do_nothing=True)
+        assert n == 6
+        assert count_row(self.engine, t_user) == 10
+
+        assert bulk_copy(self.engine, t_user, []) == 0
+
 
 if __name__ == "__main__":
     from sqlalchemy_mate.tests.helper import run_cov_test
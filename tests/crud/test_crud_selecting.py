@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import decimal
+
 import pytest
+import sqlalchemy as sa
 
 from sqlalchemy_mate.crud import selecting
 from sqlalchemy_mate.tests.api import (
@@ -14,6 +18,28 @@ from sqlalchemy_mate.tests.api import (
 )
 
 
+@contextlib.contextmanager
+def count_checkedout(engine: sa.Engine):
+    """
+    Count the connections checked out from the engine's pool in the block.
+    """
+    checkedout = [0]
+
+    def on_checkout(*args):
+        checkedout[0] += 1
+
+    def on_checkin(*args):
+        checkedout[0] -= 1
+
+    sa.event.listen(engine, "checkout", on_checkout)
+    sa.event.listen(engine, "checkin", on_checkin)
+    try:
+        yield checkedout
+    finally:
+        sa.event.remove(engine, "checkout", on_checkout)
+        sa.event.remove(engine, "checkin", on_checkin)
+
+
 class SelectingApiBaseTest(BaseCrudTest):
     @classmethod
     def class_level_data_setup(cls):
@@ -46,6 +72,31 @@ class SelectingApiBaseTest(BaseCrudTest):
     def test_count_row(self):
         assert selecting.count_row(self.engine, t_user) == 3
 
+    def test_count_row_approximate(self):
+        with self.engine.connect() as connection:
+            connection.execute(sa.text("ANALYZE"))
+            connection.commit()
+        assert selecting.count_row(self.engine, t_inv, approximate=True) == 4
+
+    def test_count_row_cache_ttl(self):
+        selecting._count_cache.clear()
+        assert selecting.count_row(self.engine, t_user, cache_ttl=60) == 3
+        with self.engine.connect() as connection:
+            connection.execute(t_user.insert(), {"user_id": 4, "name": "David"})
+            connection.commit()
+        try:
+            assert selecting.count_row(self.engine, t_user, cache_ttl=60) == 3
+            assert selecting.count_row(self.engine, t_user) == 4
+            # the cache is not shared between engines
+            other_engine = self.engine.execution_options()
+            assert selecting.count_row(other_engine, t_user, cache_ttl=60) == 4
+            assert selecting.count_row(self.engine, t_user, cache_ttl=0) == 4
+        finally:
+            with self.engine.connect() as connection:
+                connection.execute(t_user.delete().where(t_user.c.user_id == 4))
+                connection.commit()
+            selecting._count_cache.clear()
+
     def test_by_pk(self):
         row = selecting.by_pk(self.engine, t_user, 1)
         assert row._fields == ("user_id", "name")
@@ -69,6 +120,31 @@ class SelectingApiBaseTest(BaseCrudTest):
         with pytest.raises(ValueError):
             selecting.by_pk(self.engine, t_inv, (1, 2, 1, 2))
 
+    def test_by_pks(self):
+        rows = selecting.by_pks(self.engine, t_user, [3, 0, (1,), 3])
+        assert list(rows) == [3, 0, (1,)]
+        assert rows[3].name == "Cathy"
+        assert rows[0] is None
+        assert rows[(1,)].name == "Alice"
+
+        rows = selecting.by_pks(self.engine, t_inv, [[2, 2], (1, 1), (9, 9)])
+        assert list(rows) == [(2, 2), (1, 1), (9, 9)]
+        assert tuple(rows[(2, 2)]) == (2, 2)
+        assert rows[(9, 9)] is None
+
+        # the values are converted by the column type, like by_pk does
+        rows = selecting.by_pks(self.engine, t_user, ["1", ("2",)])
+        assert list(rows) == ["1", ("2",)]
+        assert rows["1"].name == "Alice"
+        assert rows[("2",)].name == "Bob"
+
+        rows = selecting.by_pks(self.engine, t_smart_insert, range(1, 1000 + 1))
+        assert len(rows) == 1000
+        assert all(row is not None for row in rows.values())
+
+        with pytest.raises(ValueError):
+            selecting.by_pks(self.engine, t_inv, [1])
+
     def test_select_all(self):
         rows = selecting.select_all(self.engine, t_user).all()
         assert len(rows) == 3
@@ -79,6 +155,197 @@ class SelectingApiBaseTest(BaseCrudTest):
         for dct in selecting.yield_dict(selecting.select_all(self.engine, t_user)):
             assert isinstance(dct, dict)
 
+    def test_yield_per(self):
+        rows = selecting.select_all(self.engine, t_smart_insert, yield_per=100)
+        assert not isinstance(rows, list)
+        assert sorted(row.id for row in rows) == list(range(1, 1000 + 1))
+
+        values = selecting.select_single_column(self.engine, t_user.c.name, yield_per=2)
+        assert sorted(values) == ["Alice", "Bob", "Cathy"]
+
+        values = selecting.select_many_column(
+            self.engine, [t_user.c.user_id, t_user.c.name], yield_per=2
+        )
+        assert sorted(values) == [(1, "Alice"), (2, "Bob"), (3, "Cathy")]
+
+        values = selecting.select_single_distinct(
+            self.engine, t_inv.c.store_id, yield_per=1
+        )
+        assert sorted(values) == [1, 2]
+
+    def test_selection_handle(self):
+        with count_checkedout(self.engine) as checkedout:
+            self._test_selection_handle(checkedout)
+
+    def _test_selection_handle(self, checkedout):
+        stmt = sa.select(t_smart_insert).order_by(t_smart_insert.c.id)
+
+        with selecting.SelectionHandle(self.engine, stmt, yield_per=100) as handle:
+            assert checkedout[0] == 1
+            assert handle.keys() == ["id"]
+            assert [row.id for row in handle.fetchmany(3)] == [1, 2, 3]
+            partitions = list(handle.partitions(500))
+            assert [len(rows) for rows in partitions] == [500, 497]
+            assert handle.fetchmany(3) == []
+        assert handle.closed
+        assert checkedout[0] == 0
+        with pytest.raises(RuntimeError):
+            handle.fetchmany()
+
+        # leaving the with block early discards the unread rows
+        with selecting.SelectionHandle(self.engine, stmt, yield_per=10) as handle:
+            assert next(handle.tuples()) == (1,)
+        assert checkedout[0] == 0
+
+        stmt = sa.text("SELECT user_id, name FROM t_user WHERE user_id = :user_id")
+        with selecting.SelectionHandle(
+            self.engine, stmt, parameters={"user_id": 1}
+        ) as handle:
+            assert list(handle.dicts()) == [{"user_id": 1, "name": "Alice"}]
+
+        # iterate without with, the connection is released after the loop
+        handle = selecting.select_all(self.engine, t_user, yield_per=2)
+        assert isinstance(handle, selecting.SelectionHandle)
+        assert sorted(row.name for row in handle) == ["Alice", "Bob", "Cathy"]
+        assert handle.closed
+        assert checkedout[0] == 0
+
+        # the column selectors stream through a handle with a row transform
+        handle = selecting.select_many_column(
+            self.engine, [t_user.c.user_id, t_user.c.name], yield_per=2
+        )
+        assert isinstance(handle, selecting.SelectionHandle)
+        with handle:
+            assert handle.fetchmany(1) in ([(1, "Alice")], [(2, "Bob")], [(3, "Cathy")])
+            assert sum(len(values) for values in handle.partitions()) == 2
+        assert checkedout[0] == 0
+
+        # the buffered results don't hold a connection
+        result = selecting.select_all(self.engine, t_user)
+        assert checkedout[0] == 0
+        assert len(result.all()) == 3
+        result = selecting.select_random(self.engine, t_smart_insert, limit=5)
+        assert checkedout[0] == 0
+        assert len(result.all()) == 5
+
+    def test_yield_per_early_break(self):
+        with count_checkedout(self.engine) as checkedout:
+            for func, column in [
+                (selecting.select_single_column, t_smart_insert.c.id),
+                (selecting.select_many_column, [t_smart_insert.c.id]),
+                (selecting.select_single_distinct, t_smart_insert.c.id),
+            ]:
+                values = func(self.engine, column, yield_per=10)
+                for _ in values:
+                    assert checkedout[0] == 1
+                    break
+                assert checkedout[0] == 0
+
+    def test_iter_rows(self):
+        rows = list(selecting.iter_rows(self.engine, t_smart_insert, batch_size=300))
+        assert [row.id for row in rows] == list(range(1, 1000 + 1))
+
+        batches = list(
+            selecting.iter_rows(
+                self.engine, t_smart_insert, batch_size=250, as_batch=True
+            )
+        )
+        assert [len(batch) for batch in batches] == [250, 250, 250, 250]
+
+        rows = list(
+            selecting.iter_rows(
+                self.engine,
+                t_smart_insert,
+                batch_size=7,
+                where=t_smart_insert.c.id > 990,
+            )
+        )
+        assert [row.id for row in rows] == list(range(991, 1000 + 1))
+
+        # composite primary key
+        for batch_size in [1, 2, 3, 10]:
+            rows = list(selecting.iter_rows(self.engine, t_inv, batch_size=batch_size))
+            assert [tuple(row) for row in rows] == [(1, 1), (1, 2), (2, 1), (2, 2)]
+
+    def test_keyset_after_expanded(self):
+        from sqlalchemy.dialects import mssql
+
+        # the expanded OR form for dialects without row value comparison
+        where = selecting._keyset_after(
+            mssql.dialect(), list(t_inv.primary_key), (1, 2)
+        )
+        assert " OR " in str(where.compile(dialect=mssql.dialect()))
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                sa.select(t_inv).where(where).order_by(*t_inv.primary_key)
+            ).all()
+        assert [tuple(row) for row in rows] == [(2, 1), (2, 2)]
+
+    def test_select_columnar(self):
+        np = pytest.importorskip("numpy")
+
+        arrays = selecting.select_columnar(
+            self.engine, [t_smart_insert.c.id], as_="numpy", chunk_size=300
+        )
+        assert arrays["id"].dtype == np.int64
+        assert sorted(arrays["id"].tolist()) == list(range(1, 1000 + 1))
+
+        arrays = selecting.select_columnar(
+            self.engine,
+            [t_user.c.user_id, t_user.c.name],
+            as_="numpy",
+            chunk_size=2,
+            where=t_user.c.user_id <= 2,
+        )
+        assert arrays["user_id"].dtype == np.int64
+        assert arrays["name"].dtype == object
+        assert sorted(zip(arrays["user_id"], arrays["name"])) == [
+            (1, "Alice"),
+            (2, "Bob"),
+        ]
+
+        lists = selecting.select_columnar(
+            self.engine, [t_inv.c.store_id, t_inv.c.item_id], as_="dict_of_lists"
+        )
+        assert sorted(zip(lists["store_id"], lists["item_id"])) == [
+            (1, 1),
+            (1, 2),
+            (2, 1),
+            (2, 2),
+        ]
+
+        with pytest.raises(ValueError):
+            selecting.select_columnar(self.engine, [t_user.c.name], as_="pandas")
+
+    def test_select_columnar_arrow(self):
+        pytest.importorskip("pyarrow")
+
+        table = selecting.select_columnar(
+            self.engine, [t_user.c.user_id, t_user.c.name], as_="arrow", chunk_size=2
+        )
+        assert table.num_rows == 3
+        assert sorted(table.column("name").to_pylist()) == ["Alice", "Bob", "Cathy"]
+
+        # numeric and binary values span multiple chunks
+        table = selecting.select_columnar(
+            self.engine,
+            [
+                sa.cast(t_smart_insert.c.id / 8.0, sa.Numeric(10, 3)).label("amount"),
+                sa.cast(t_smart_insert.c.id, sa.Numeric).label("number"),
+                sa.cast(sa.cast(t_smart_insert.c.id, sa.String), sa.LargeBinary).label(
+                    "blob"
+                ),
+            ],
+            as_="arrow",
+            chunk_size=300,
+        )
+        assert table.num_rows == 1000
+        assert table.column("amount").num_chunks == 4
+        assert str(table.column("amount").type) == "decimal128(10, 3)"
+        assert sorted(table.column("amount").to_pylist())[-1] == decimal.Decimal("125")
+        assert sorted(table.column("number").to_pylist())[-1] == 1000
+        assert str(table.column("blob").type) == "binary"
+
     def test_select_single_column(self):
         data = selecting.select_single_column(self.engine, t_user.c.user_id)
         assert data == [1, 2, 3]
@@ -185,6 +452,62 @@ class SelectingApiBaseTest(BaseCrudTest):
 
         self.psql_only_test_case()
 
+    def test_select_random_strategy(self):
+        id_set = set(range(1, 1000 + 1))
+        strategies = ["order_by_random", "pk_range", "reservoir"]
+        if self.engine.dialect.name == "postgresql":
+            strategies.extend(["tablesample_system", "tablesample_bernoulli"])
+        for strategy in strategies:
+            ids = [
+                id_
+                for (id_,) in selecting.select_random(
+                    engine=self.engine,
+                    columns=[t_smart_insert.c.id],
+                    limit=5,
+                    strategy=strategy,
+                )
+            ]
+            assert len(set(ids)) == 5
+            assert set(ids).issubset(id_set)
+
+        # composite primary key, limit is more than the number of rows
+        rows = selecting.select_random(
+            engine=self.engine, table=t_inv, limit=10, strategy="reservoir"
+        ).all()
+        assert sorted([tuple(row) for row in rows]) == [(1, 1), (1, 2), (2, 1), (2, 2)]
+        rows = selecting.select_random(engine=self.engine, table=t_inv, limit=2).all()
+        assert len(rows) == 2
+
+        # perc is converted to number of rows with the planner statistics
+        with self.engine.connect() as connection:
+            connection.execute(sa.text("ANALYZE"))
+            connection.commit()
+        rows = selecting.select_random(
+            engine=self.engine, table=t_smart_insert, perc=10, strategy="pk_range"
+        ).all()
+        assert len(set(rows)) == 100
+
+        with pytest.raises(ValueError):
+            selecting.select_random(
+                engine=self.engine, table=t_inv, limit=2, strategy="pk_range"
+            )
+
+        with pytest.raises(ValueError):
+            selecting.select_random(
+                engine=self.engine, table=t_inv, limit=2, strategy="unknown"
+            )
+
+    def test_sample_pks_by_range_sparse(self):
+        with self.engine.connect() as connection:
+            connection.execute(t_user.insert(), {"user_id": 1000000, "name": "Zed"})
+            connection.commit()
+            try:
+                pks = selecting._sample_pks_by_range(connection, t_user, 4)
+                assert sorted(pks) == [(1,), (2,), (3,), (1000000,)]
+            finally:
+                connection.execute(t_user.delete().where(t_user.c.user_id == 1000000))
+                connection.commit()
+
     def psql_only_test_case(self):
         id_set = set(range(1, 1000 + 1))
 
@@ -212,6 +535,13 @@ class SelectingApiBaseTest(BaseCrudTest):
 class TestSelectingApiSqlite(SelectingApiBaseTest):
     engine = engine_sqlite
 
+    def test_count_row_approximate_fallback(self):
+        # no statistics, fall back to exact count
+        with self.engine.connect() as connection:
+            connection.execute(sa.text("DROP TABLE IF EXISTS sqlite_stat1"))
+            connection.commit()
+        assert selecting.count_row(self.engine, t_user, approximate=True) == 3
+
     def psql_only_test_case(self):
         pass
 
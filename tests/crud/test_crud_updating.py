@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from datetime import datetime
+
 import pytest
 
 from sqlalchemy_mate.crud import selecting
@@ -10,6 +12,9 @@ from sqlalchemy_mate.tests.api import (
     engine_psql,
     t_cache,
     t_graph,
+    t_inv,
+    t_doc,
+    t_user,
     BaseCrudTest,
 )
 
@@ -76,6 +81,411 @@ class UpdatingApiBaseTest(BaseCrudTest):
             (1, 4, 4),
         ]
 
+    def test_update_all(self):
+        with self.engine.connect() as connection:
+            connection.execute(
+                t_graph.insert(),
+                [
+                    {"x_node_id": 1, "y_node_id": 1, "value": 0},
+                    {"x_node_id": 1, "y_node_id": 2, "value": 0},
+                    {"x_node_id": 2, "y_node_id": 1, "value": 0},
+                ],
+            )
+            connection.commit()
+
+        for strategy in ["executemany", "row_by_row", "staging"]:
+            data = [
+                {"x_node_id": 1, "y_node_id": 1, "value": 1},  # This will update
+                {"x_node_id": 1, "y_node_id": 2},  # This will update, nothing changed
+                {"x_node_id": 2, "y_node_id": 1, "value": 1},  # This will update
+                {"x_node_id": 3, "y_node_id": 1, "value": 1},  # Not exists
+            ]
+            update_counter, insert_counter = updating.update_all(
+                self.engine, t_graph, data, strategy=strategy
+            )
+            assert update_counter == 3
+            assert insert_counter == 0
+
+            assert sorted(selecting.select_all(self.engine, t_graph).all()) == [
+                (1, 1, 1),
+                (1, 2, 0),
+                (2, 1, 1),
+            ]
+
+        with pytest.raises(ValueError):
+            updating.update_all(self.engine, t_graph, data, strategy="invalid")
+
+    def test_upsert_all_staging(self):
+        with self.engine.connect() as connection:
+            connection.execute(
+                t_graph.insert(),
+                [{"x_node_id": 1, "y_node_id": i, "value": 0} for i in range(10)],
+            )
+            connection.execute(
+                t_inv.insert(), [{"store_id": 1, "item_id": i} for i in range(10)]
+            )
+            connection.commit()
+
+        data = [{"x_node_id": 1, "y_node_id": i, "value": i} for i in range(5, 15)]
+        data.append({"x_node_id": 1, "y_node_id": 5, "value": -1})  # last one wins
+        data.append({"x_node_id": 2, "y_node_id": 1})  # different set of keys
+        update_counter, insert_counter = updating.upsert_all(
+            self.engine, t_graph, data, strategy="staging"
+        )
+        assert update_counter == 5
+        assert insert_counter == 6
+        rows = sorted(selecting.select_all(self.engine, t_graph).all())
+        assert len(rows) == 16
+        assert rows[4] == (1, 4, 0)
+        assert rows[5] == (1, 5, -1)
+        assert rows[-1] == (2, 1, None)
+
+        # all columns are primary key, nothing to update
+        data = [{"store_id": 1, "item_id": i} for i in range(5, 15)]
+        update_counter, insert_counter = updating.upsert_all(
+            self.engine, t_inv, data, strategy="staging"
+        )
+        assert update_counter == 5
+        assert insert_counter == 5
+        assert len(selecting.select_all(self.engine, t_inv).all()) == 15
+
+    def test_upsert_all_skip_unchanged(self):
+        with self.engine.connect() as connection:
+            connection.execute(
+                t_cache.insert(), [{"key": f"k{i}", "value": i} for i in range(5)]
+            )
+            connection.commit()
+
+        data = [{"key": f"k{i}", "value": i} for i in range(3)]  # unchanged
+        data.append({"key": "k3", "value": -1})  # update
+        data.append({"key": "k9", "value": 9})  # insert
+        for strategy in [None, "executemany", "staging"]:
+            counters = updating.upsert_all(
+                self.engine, t_cache, data, strategy=strategy, skip_unchanged=True
+            )
+            if strategy is None:
+                assert counters == (1, 1, 3)
+            else:
+                assert counters == (0, 0, 5)
+
+        rows = dict(selecting.select_all(self.engine, t_cache).all())
+        assert rows["k3"] == -1
+        assert rows["k9"] == 9
+
+        # compare by hash column only
+        counters = updating.update_all(
+            self.engine,
+            t_cache,
+            [{"key": "k3", "value": -1}, {"key": "k4", "value": 0}],
+            skip_unchanged=True,
+            hash_column="value",
+        )
+        assert counters == (1, 0, 1)
+        assert dict(selecting.select_all(self.engine, t_cache).all())["k4"] == 0
+
+    def test_update_all_version_column(self):
+        with self.engine.connect() as connection:
+            connection.execute(
+                t_doc.insert(),
+                [{"doc_id": i, "version": 1, "body": "v1"} for i in range(1, 11)],
+            )
+            connection.commit()
+
+        # another writer already moved doc 3 and doc 7 to version 2
+        updating.update_all(
+            self.engine,
+            t_doc,
+            [{"doc_id": 3, "version": 2}, {"doc_id": 7, "version": 2}],
+        )
+
+        data = [{"doc_id": i, "version": 1, "body": "v2"} for i in range(1, 11)]
+        data.append({"doc_id": 11, "version": 1, "body": "v2"})
+        conflicts = list()
+        update_counter, insert_counter = updating.upsert_all(
+            self.engine,
+            t_doc,
+            data,
+            strategy="executemany",
+            version_column="version",
+            conflicts=conflicts,
+        )
+        assert update_counter == 8
+        assert insert_counter == 1
+        assert [r.row["doc_id"] for r in conflicts] == [3, 7]
+        assert conflicts[0].error_name == "sqlalchemy.orm.exc.StaleDataError"
+
+        rows = {
+            row.doc_id: row for row in selecting.select_all(self.engine, t_doc).all()
+        }
+        assert (rows[1].version, rows[1].body) == (2, "v2")
+        assert (rows[3].version, rows[3].body) == (2, "v1")
+        assert (rows[11].version, rows[11].body) == (1, "v2")
+
+        # non integer version column
+        last_seen = datetime(2000, 1, 1)
+        with self.engine.connect() as connection:
+            connection.execute(t_doc.update().values(updated_at=last_seen))
+            connection.commit()
+        data = [
+            {"doc_id": 1, "updated_at": last_seen, "body": "v3"},
+            {"doc_id": 2, "updated_at": datetime(1999, 1, 1), "body": "v3"},
+        ]
+        conflicts = list()
+        update_counter, insert_counter = updating.update_all(
+            self.engine,
+            t_doc,
+            data,
+            version_column="updated_at",
+            conflicts=conflicts.append,
+        )
+        assert update_counter == 1
+        assert [r.row["doc_id"] for r in conflicts] == [2]
+        rows = {
+            row.doc_id: row for row in selecting.select_all(self.engine, t_doc).all()
+        }
+        assert rows[1].updated_at > last_seen
+        assert rows[2].updated_at == last_seen
+
+        # a writer reads the row back and updates it again, twice
+        for body in ["v4", "v5"]:
+            seen = selecting.by_pk(self.engine, t_doc, 1).updated_at
+            conflicts = list()
+            counters = updating.update_all(
+                self.engine,
+                t_doc,
+                [{"doc_id": 1, "updated_at": seen, "body": body}],
+                version_column="updated_at",
+                conflicts=conflicts,
+            )
+            assert counters == (1, 0)
+            assert conflicts == []
+            row = selecting.by_pk(self.engine, t_doc, 1)
+            assert row.updated_at > seen
+            assert row.body == body
+
+        # the stale version is rejected
+        conflicts = list()
+        counters = updating.update_all(
+            self.engine,
+            t_doc,
+            [{"doc_id": 1, "updated_at": seen, "body": "v6"}],
+            version_column="updated_at",
+            conflicts=conflicts,
+        )
+        assert counters == (0, 0)
+        assert [r.row["doc_id"] for r in conflicts] == [1]
+
+        with pytest.raises(ValueError):
+            updating.update_all(
+                self.engine,
+                t_doc,
+                [{"doc_id": 1, "body": "v1"}],
+                version_column="body",
+            )
+
+        with pytest.raises(ValueError):
+            updating.update_all(
+                self.engine, t_doc, [{"doc_id": 1}], version_column="version"
+            )
+
+    def test_update_all_version_column_null(self):
+        with self.engine.connect() as connection:
+            connection.execute(
+                t_doc.insert(),
+                [
+                    {"doc_id": 1, "version": None, "body": "v1"},
+                    {"doc_id": 2, "version": None, "body": "v1"},
+                ],
+            )
+            connection.commit()
+
+        data = [
+            {"doc_id": 1, "version": None, "updated_at": None, "body": "v2"},
+            {"doc_id": 2, "version": 1, "updated_at": None, "body": "v2"},
+        ]
+        conflicts = list()
+        update_counter, insert_counter = updating.update_all(
+            self.engine,
+            t_doc,
+            data,
+            version_column="version",
+            conflicts=conflicts,
+        )
+        assert update_counter == 1
+        assert [r.row["doc_id"] for r in conflicts] == [2]
+        rows = {
+            row.doc_id: row for row in selecting.select_all(self.engine, t_doc).all()
+        }
+        assert (rows[1].version, rows[1].body) == (1, "v2")
+        assert (rows[2].version, rows[2].body) == (None, "v1")
+
+        # NULL timestamp version
+        data = [{"doc_id": 2, "updated_at": None, "body": "v3"}]
+        update_counter, insert_counter = updating.update_all(
+            self.engine, t_doc, data, version_column="updated_at"
+        )
+        assert update_counter == 1
+        rows = {
+            row.doc_id: row for row in selecting.select_all(self.engine, t_doc).all()
+        }
+        assert rows[2].updated_at is not None
+        assert rows[2].body == "v3"
+
+    def test_upsert_all_merge_policy(self):
+        last_seen = datetime(2000, 1, 1)
+        with self.engine.connect() as connection:
+            connection.execute(
+                t_doc.insert(),
+                [
+                    {"doc_id": 1, "version": 10, "updated_at": last_seen, "body": "a"},
+                    {"doc_id": 2, "version": None, "updated_at": None, "body": "b"},
+                ],
+            )
+            connection.commit()
+
+        merge_policy = {"version": "sum", "updated_at": "max", "body": "coalesce"}
+        data = [
+            {
+                "doc_id": 1,
+                "version": 1,
+                "updated_at": datetime(1999, 1, 1),
+                "body": None,
+            },
+            {"doc_id": 2, "version": 1, "updated_at": last_seen, "body": "b2"},
+            {"doc_id": 3, "version": 1, "updated_at": last_seen, "body": "c"},
+            {
+                "doc_id": 1,
+                "version": 1,
+                "updated_at": datetime(2001, 1, 1),
+                "body": "a2",
+            },
+        ]
+        update_counter, insert_counter = updating.upsert_all(
+            self.engine, t_doc, data, merge_policy=merge_policy
+        )
+        assert update_counter == 3
+        assert insert_counter == 1
+
+        rows = {
+            row.doc_id: tuple(row)[1:]
+            for row in selecting.select_all(self.engine, t_doc).all()
+        }
+        assert rows == {
+            1: (12, datetime(2001, 1, 1), "a2"),
+            2: (1, last_seen, "b2"),
+            3: (1, last_seen, "c"),
+        }
+
+        # keep_existing and min
+        data = [{"doc_id": 1, "version": 0, "updated_at": last_seen, "body": "x"}]
+        updating.upsert_all(
+            self.engine,
+            t_doc,
+            data,
+            merge_policy={
+                "version": "min",
+                "updated_at": "min",
+                "body": "keep_existing",
+            },
+        )
+        rows = {row.doc_id: row for row in selecting.select_all(self.engine, t_doc)}
+        assert tuple(rows[1]) == (1, 0, last_seen, "a2")
+
+        with pytest.raises(ValueError):
+            updating.upsert_all(
+                self.engine, t_doc, data, merge_policy={"version": "invalid"}
+            )
+        with pytest.raises(NotImplementedError):
+            updating.upsert_all(
+                self.engine,
+                t_doc,
+                data,
+                strategy="executemany",
+                merge_policy={"version": "sum"},
+            )
+
+    def test_upsert_returning(self):
+        self.delete_all_data_in_core_table()
+        with self.engine.connect() as connection:
+            connection.execute(t_doc.insert(), [{"doc_id": 1, "version": 10}])
+            connection.execute(t_user.insert(), [{"user_id": 1000000, "name": "Alice"}])
+            connection.execute(t_inv.insert(), [{"store_id": 1, "item_id": 1}])
+            connection.commit()
+
+        rows = updating.upsert_returning(
+            self.engine,
+            t_doc,
+            [
+                {"doc_id": 2, "version": 1},
+                {"doc_id": 1, "version": 1},
+                {"doc_id": 2, "version": 1},
+            ],
+            merge_policy={"version": "sum"},
+        )
+        assert [tuple(row) for row in rows] == [(2, 2, None, None), (1, 11, None, None)]
+
+        # server generated primary key
+        rows = updating.upsert_returning(
+            self.engine,
+            t_user,
+            [{"name": "Bob"}, {"user_id": 1000000, "name": "Adam"}],
+            as_dict=True,
+        )
+        assert rows[0] == {"user_id": 1000000, "name": "Adam"}
+        assert rows[1]["name"] == "Bob"
+        assert isinstance(rows[1]["user_id"], int)
+
+        # nothing to update, existing rows are selected
+        rows = updating.upsert_returning(
+            self.engine,
+            t_inv,
+            [{"store_id": 1, "item_id": 1}, {"store_id": 1, "item_id": 2}],
+        )
+        assert [tuple(row) for row in rows] == [(1, 1), (1, 2)]
+
+    def test_upsert_all_batch(self):
+        with self.engine.connect() as connection:
+            connection.execute(
+                t_cache.insert(), [{"key": f"k{i}", "value": 0} for i in range(50)]
+            )
+            connection.commit()
+
+        data = [{"key": f"k{i}", "value": i} for i in range(100)]
+        data.append({"key": "k0", "value": -1})  # duplicate key, the last one wins
+        data.append({"key": "k100"})  # different set of keys
+        data.append({"key": "k1"})  # nothing to update
+        update_counter, insert_counter = updating.upsert_all(
+            self.engine, t_cache, data, batch_size=30
+        )
+        assert update_counter == 52
+        assert insert_counter == 51
+
+        rows = dict(selecting.select_all(self.engine, t_cache).all())
+        assert len(rows) == 101
+        assert rows["k0"] == -1
+        assert rows["k1"] == 1
+        assert rows["k99"] == 99
+        assert rows["k100"] is None
+
+    def test_update_all_repeated_primary_key_input_order(self):
+        # the same primary key with different sets of keys
+        data = [
+            {"doc_id": 1, "version": 1, "body": "a"},
+            {"doc_id": 1, "version": 2},
+            {"doc_id": 1, "version": 3, "body": "c"},
+        ]
+        for strategy in ["executemany", "row_by_row", "staging", None]:
+            with self.engine.connect() as connection:
+                connection.execute(t_doc.insert(), {"doc_id": 1, "version": 0})
+                connection.commit()
+            if strategy is None:
+                updating.upsert_all(self.engine, t_doc, data)
+            else:
+                updating.update_all(self.engine, t_doc, data, strategy=strategy)
+            rows = selecting.select_all(self.engine, t_doc).all()
+            assert [(row.version, row.body) for row in rows] == [(3, "c")]
+            self.delete_all_data_in_core_table()
+
 
 class TestUpdatingApiSqlite(UpdatingApiBaseTest):
     engine = engine_sqlite
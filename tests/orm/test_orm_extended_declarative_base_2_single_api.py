@@ -69,6 +69,29 @@ class SingleOperationBaseTest(BaseCrudTest):
             assert Association.by_pk(ses, [1, 2]).flag == 999
             assert Association.by_pk(ses, [0, 0]) is None
 
+    def test_by_pks(self):
+        with orm.Session(self.eng) as ses:
+            ses.add_all([User(id=1, name="alice"), User(id=2, name="bob")])
+            ses.add(Association(x_id=1, y_id=2, flag=999))
+            ses.commit()
+
+        users = User.by_pks(self.eng, [2, 0, 1])
+        assert list(users) == [2, 0, 1]
+        assert users[2].name == "bob"
+        assert users[0] is None
+        assert users[1].name == "alice"
+
+        users = User.by_pks(self.eng, ["1"])
+        assert users["1"].name == "alice"
+
+        with orm.Session(self.eng) as ses:
+            associations = Association.by_pks(ses, [[1, 2], (0, 0)])
+            assert associations[(1, 2)].flag == 999
+            assert associations[(0, 0)] is None
+
+        with pytest.raises(ValueError):
+            Association.by_pks(self.eng, [1])
+
     def test_by_sql(self):
         assert User.count_all(self.eng) == 0
         with orm.Session(self.eng) as ses:
@@ -80,6 +103,8 @@ class SingleOperationBaseTest(BaseCrudTest):
             ses.add_all(user_list)
             ses.commit()
         assert User.count_all(self.eng) == 3
+        assert User.count_all(self.eng, approximate=True) >= 0
+        assert User.count_all(self.eng, cache_ttl=60) == 3
 
         expected = ["mr y", "mr z"]
 
@@ -9,6 +9,7 @@ import random
 
 import pytest
 
+import sqlalchemy as sa
 import sqlalchemy.orm as orm
 from sqlalchemy.orm.exc import FlushError
 from sqlalchemy.exc import IntegrityError
@@ -107,6 +108,45 @@ class BulkOperationTestBase(BaseCrudTest):
         User.smart_insert(self.eng, user)
         assert User.count_all(self.eng) == 1
 
+    def test_smart_insert_use_savepoint(self):
+        User.smart_insert(self.eng, [User(id=id) for id in range(1, 100 + 1, 10)])
+
+        op_counter, insert_counter = User.smart_insert(
+            self.eng,
+            [User(id=id) for id in range(1, 100 + 1)],
+            use_savepoint=True,
+        )
+        assert insert_counter == 90
+        assert User.count_all(self.eng) == 100
+
+        with orm.Session(self.engine) as ses:
+            op_counter, insert_counter = User.smart_insert(
+                ses,
+                [User(id=id) for id in range(91, 110 + 1)],
+                use_savepoint=True,
+                commit_every=5,
+            )
+            assert insert_counter == 10
+        assert User.count_all(self.eng) == 110
+
+    def test_smart_insert_rejected(self):
+        User.smart_insert(self.eng, [User(id=2), User(id=4)])
+
+        rejected = list()
+        op_counter, insert_counter = User.smart_insert(
+            self.eng,
+            [User(id=id) for id in range(1, 6 + 1)],
+            rejected=rejected,
+        )
+        assert insert_counter == 4
+        assert [r.row.id for r in rejected] == [2, 4]
+        assert [r.to_dict() for r in rejected] == [
+            {"id": 2, "name": None},
+            {"id": 4, "name": None},
+        ]
+        for r in rejected:
+            assert issubclass(r.error_class, Exception)
+
     def test_smart_update(self):
         # single primary key column
         # ------ Before State ------
@@ -197,6 +237,59 @@ class BulkOperationTestBase(BaseCrudTest):
             assert ses.get(Association, (1, 1)).flag == 999
             assert ses.get(Association, (1, 2)).flag == 2
 
+    def test_smart_update_batch(self):
+        User.smart_insert(self.eng, [User(id=i, name="old") for i in range(1, 6)])
+
+        update_count, insert_count = User.upsert_all(
+            self.eng,
+            [User(id=i, name="new") for i in range(3, 9)] + [User(id=1)],
+            include_null=False,
+            batch_size=2,
+        )
+        assert update_count == 4
+        assert insert_count == 3
+
+        with orm.Session(self.eng) as ses:
+            assert User.count_all(ses) == 8
+            assert ses.get(User, 1).name == "old"  # None value is not updated
+            assert ses.get(User, 2).name == "old"
+            assert ses.get(User, 5).name == "new"
+            assert ses.get(User, 8).name == "new"
+
+    def test_smart_update_skip_unchanged(self):
+        User.smart_insert(self.eng, [User(id=1, name="Alice"), User(id=2, name="Bob")])
+
+        update_count, insert_count, unchanged_count = User.upsert_all(
+            self.eng,
+            [
+                User(id=1, name="Alice"),  # unchanged
+                User(id=2, name="Bruce"),  # update
+                User(id=3, name="Cathy"),  # insert
+            ],
+            skip_unchanged=True,
+        )
+        assert update_count == 1
+        assert insert_count == 1
+        assert unchanged_count == 1
+
+        with orm.Session(self.eng) as ses:
+            assert ses.get(User, 2).name == "Bruce"
+            assert ses.get(User, 3).name == "Cathy"
+
+        # compare by one column only
+        update_count, insert_count, unchanged_count = User.update_all(
+            self.eng,
+            [
+                User(id=1, name="Alice"),
+                User(id=2, name="Bob"),
+            ],
+            skip_unchanged=True,
+            hash_column="name",
+        )
+        assert update_count == 1
+        assert insert_count == 0
+        assert unchanged_count == 1
+
     def test_select_all(self):
         with orm.Session(self.eng) as ses:
             ses.add_all(
@@ -229,6 +322,16 @@ class BulkOperationTestBase(BaseCrudTest):
 
         assert sum([od1.id != od2.id for od1, od2 in zip(result1, result2)]) >= 1
 
+        for strategy in ["order_by_random", "pk_range", "reservoir"]:
+            result = Order.random_sample(self.eng, limit=5, strategy=strategy)
+            assert len({od.id for od in result}) == 5
+
+        with self.eng.connect() as connection:
+            connection.execute(sa.text("ANALYZE"))
+            connection.commit()
+        result = Order.random_sample(self.eng, perc=10, strategy="pk_range")
+        assert len({od.id for od in result}) == 100
+
         self.psql_only_test_case()
 
     def psql_only_test_case(self):
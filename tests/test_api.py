@@ -13,6 +13,7 @@ def test():
     _ = sam.selecting.select_single_distinct
     _ = sam.selecting.select_many_distinct
     _ = sam.selecting.select_random
+    _ = sam.selecting.SelectionHandle
     _ = sam.selecting.yield_tuple
     _ = sam.selecting.yield_dict
     _ = sam.inserting.smart_insert
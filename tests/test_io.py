@@ -38,6 +38,18 @@ class DataIOTestBase(BaseCrudTest):
         filepath = __file__.replace("test_io.py", "t_user.csv")
         io.table_to_csv(t_user, self.engine, filepath, chunksize=1, overwrite=True)
 
+    def test_table_to_csv_stream(self):
+        filepath = __file__.replace("test_io.py", "t_user.csv")
+        io.table_to_csv(
+            t_user, self.engine, filepath, chunksize=2, overwrite=True, stream=True
+        )
+        with self.engine.connect() as connection:
+            rows = connection.execute(t_user.select()).all()
+        with open(filepath) as f:
+            lines = f.read().splitlines()
+        assert lines[0] == "user_id,name"
+        assert sorted(lines[1:]) == sorted(f"{id},{name}" for id, name in rows)
+
 
 class TestDataIOSqlite(DataIOTestBase):
     engine = engine_sqlite
@@ -20,6 +20,15 @@ def test_ensure_list():
     assert utils.ensure_list((1, 2, 3)) == (1, 2, 3)
 
 
+def test_get_max_rows_per_statement():
+    from sqlalchemy.dialects import mssql, postgresql
+
+    assert utils.get_max_bind_params(mssql.dialect()) == 2099
+    assert utils.get_max_rows_per_statement(mssql.dialect(), 10) == 209
+    assert utils.get_max_rows_per_statement(postgresql.dialect(), 1) == 32767
+    assert utils.get_max_rows_per_statement(mssql.dialect(), 5000) == 1
+
+
 class UtilityTestBase(BaseCrudTest):
     def test_timeout_good_case(self):
         utils.test_connection(self.engine, timeout=3)